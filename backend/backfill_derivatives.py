@@ -0,0 +1,108 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+from database import SessionLocal, Image
+from image_pipeline import decode_image, derivative_decode_side, exif_orientation
+from ingest_worker import read_original, stem_of, store_image_derivatives
+
+"""Create thumb/preview derivatives for images stored before ingestion made them
+
+    python backfill_derivatives.py              # rows missing a thumbnail or preview
+    python backfill_derivatives.py --all        # regenerate every row (e.g. new sizes)
+    python backfill_derivatives.py --limit 500  # stop after 500 rows
+
+Derivatives are written next to each original, under the same stem, and the
+row is updated as each chunk finishes. Run it again to resume, since the rows
+already done are skipped.
+"""
+
+logger = logging.getLogger("backfill")
+
+
+def _rows(batch_size: int, everything: bool) -> Iterator[List[Tuple[int, str]]]:
+    """Keyset-paginated (id, url) chunks that still need derivatives"""
+    after_id = 0
+    while True:
+        db = SessionLocal()
+        try:
+            query = db.query(Image.id, Image.s3_url).filter(Image.id > after_id)
+            if not everything:
+                query = query.filter((Image.thumb_url.is_(None)) | (Image.preview_url.is_(None)))
+            chunk = query.order_by(Image.id).limit(batch_size).all()
+        finally:
+            db.close()
+        if not chunk:
+            return
+        yield [(row.id, row.s3_url) for row in chunk]
+        after_id = chunk[-1].id
+
+
+def _derive(item: Tuple[int, str]) -> Tuple[int, Optional[dict]]:
+    """Download, decode once and store both derivatives for one row"""
+    image_id, stored_url = item
+    stem = stem_of(stored_url)
+    content = read_original(stored_url)
+    if not stem or not content:
+        logger.warning(f"Original for image {image_id} not found: {stored_url}")
+        return image_id, None
+    try:
+        image = decode_image(content, derivative_decode_side())
+    except Exception as e:
+        logger.warning(f"Could not decode image {image_id}: {e}")
+        return image_id, None
+    urls = store_image_derivatives(stem, image, exif_orientation(content))
+    if not urls:
+        return image_id, None
+    return image_id, {"id": image_id, "thumb_url": urls.get("thumb"), "preview_url": urls.get("preview")}
+
+
+def run(args) -> int:
+    done = failed = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.workers, thread_name_prefix="backfill") as pool:
+        for chunk in _rows(args.batch_size, args.all):
+            if args.limit and done + failed >= args.limit:
+                break
+            if args.limit:
+                chunk = chunk[: args.limit - done - failed]
+            updates = []
+            for image_id, update in pool.map(_derive, chunk):
+                if update is None:
+                    failed += 1
+                else:
+                    updates.append(update)
+            db = SessionLocal()
+            try:
+                db.bulk_update_mappings(Image, updates)
+                db.commit()
+            finally:
+                db.close()
+            done += len(updates)
+            elapsed = time.perf_counter() - started
+            logger.info(f"{done} images backfilled up to id {chunk[-1][0]} ({done / max(elapsed, 1e-9):.1f}/s, {failed} failed)")
+    logger.info(f"Backfilled {done} images ({failed} failed)")
+    return 0 if failed == 0 else 1
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Generate thumbnail and preview derivatives for existing images")
+    parser.add_argument("--all", action="store_true", help="regenerate derivatives for every image")
+    parser.add_argument("--limit", type=int, default=0, help="stop after this many images (0 = no limit)")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=max(1, os.cpu_count() or 1))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+import argparse
+import glob
+import os
+import statistics
+import time
+from typing import Callable, List
+
+import numpy as np
+from PIL import Image
+
+import ml_models
+
+"""Latency, throughput and embedding drift of each INFERENCE_BACKEND against fp32
+
+    python bench_inference.py --images ./uploads --limit 64
+    python bench_inference.py --images ./uploads --backends torch,torch-int8,onnx --captions
+
+CLIP runs per backend over the sample images and a set of text queries. Drift
+is the cosine similarity of each embedding to the fp32 PyTorch embedding of
+the same input (1.0 = identical). With --captions, BLIP fp32 and int8 are
+compared on caption latency and agreement.
+"""
+
+DEFAULT_QUERIES = [
+    "a dog playing in the snow", "sunset over the ocean", "a red bicycle", "people at a wedding",
+    "a plate of food", "mountains with a lake", "a cat sleeping on a couch", "city skyline at night",
+    "a child blowing out birthday candles", "a car parked on the street", "flowers in a garden",
+    "a group photo on the beach", "a birthday cake", "an old building", "a snowy forest", "a concert crowd",
+]
+
+
+def _load_images(directory: str, limit: int) -> List[Image.Image]:
+    paths = []
+    for pattern in ("*.jpg", "*.jpeg", "*.png", "*.webp"):
+        paths.extend(glob.glob(os.path.join(directory, "**", pattern), recursive=True))
+    images = []
+    for path in sorted(paths)[:limit]:
+        try:
+            images.append(Image.open(path).convert("RGB"))
+        except Exception:
+            pass
+    return images
+
+
+def _timed(fn: Callable, repeats: int) -> List[float]:
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    return samples
+
+
+def _cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def bench_clip(backends: List[str], images, queries, batch_size: int, repeats: int) -> None:
+    from sentence_transformers import SentenceTransformer
+
+    reference = None
+    print(f"CLIP: {len(images)} images, {len(queries)} queries, batch {batch_size}")
+    print(
+        f"{'backend':12} {'text ms':>9} {'image ms':>9} {'imgs/s':>8} {'queries/s':>10} "
+        f"{'img cos mean':>13} {'img cos min':>12} {'txt cos min':>12}"
+    )
+    # fp32 first: it is the reference every other backend is compared with
+    for backend in ["torch"] + [b for b in backends if b != "torch"]:
+        encoder, used = ml_models.build_clip_encoder(SentenceTransformer("clip-ViT-B-32"), backend)
+        encoder.encode_text(queries[:1])  # warm-up
+        encoder.encode_images(images[:1])
+
+        # Bound as defaults so the closures don't keep `encoder` alive past the del below
+        text_latency = statistics.median(
+            s for q in queries for s in _timed(lambda q=q, encoder=encoder: encoder.encode_text([q]), 1)
+        )
+        image_latency = statistics.median(_timed(lambda encoder=encoder: encoder.encode_images(images[:1]), repeats))
+
+        batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+        started = time.perf_counter()
+        image_embeddings = np.concatenate([encoder.encode_images(batch) for batch in batches])
+        images_per_s = len(images) / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        text_embeddings = encoder.encode_text(queries)
+        queries_per_s = len(queries) / (time.perf_counter() - started)
+
+        if reference is None:
+            reference = (image_embeddings, text_embeddings)
+        image_cos = _cosine(image_embeddings, reference[0])
+        text_cos = _cosine(text_embeddings, reference[1])
+        label = backend if used == backend else f"{backend}->{used}"
+        print(
+            f"{label:12} {text_latency:9.1f} {image_latency:9.1f} {images_per_s:8.1f} {queries_per_s:10.1f} "
+            f"{image_cos.mean():13.5f} {image_cos.min():12.5f} {text_cos.min():12.5f}"
+        )
+        del encoder
+
+
+def bench_blip(images, repeats: int) -> None:
+    import torch
+    from transformers import BlipForConditionalGeneration, BlipProcessor
+
+    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+    print(f"\nBLIP: {len(images)} images")
+    print(f"{'backend':12} {'ms/image':>9} {'exact match':>12} {'word overlap':>13}")
+    reference = None
+    for backend in ("torch", "torch-int8"):
+        model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base").eval()
+        model, _ = ml_models.build_blip(model, backend)
+
+        def caption_all(model=model):
+            captions = []
+            for image in images:
+                inputs = processor(images=[image], return_tensors="pt")
+                with torch.no_grad():
+                    out = model.generate(**inputs, max_length=50)
+                captions.extend(processor.batch_decode(out, skip_special_tokens=True))
+            return captions
+
+        started = time.perf_counter()
+        captions = caption_all()
+        per_image = (time.perf_counter() - started) * 1000.0 / max(len(images), 1)
+        if reference is None:
+            reference = captions
+        exact = sum(a == b for a, b in zip(captions, reference)) / max(len(captions), 1)
+        overlap = statistics.mean(
+            len(set(a.split()) & set(b.split())) / max(len(set(a.split()) | set(b.split())), 1)
+            for a, b in zip(captions, reference)
+        ) if captions else 0.0
+        print(f"{backend:12} {per_image:9.1f} {exact:12.2%} {overlap:13.2%}")
+        del model
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compare CPU inference backends against fp32")
+    parser.add_argument("--images", required=True, help="directory of sample images")
+    parser.add_argument("--limit", type=int, default=64, help="max images to sample")
+    parser.add_argument("--backends", default=",".join(ml_models.INFERENCE_BACKENDS))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--captions", action="store_true", help="also compare BLIP fp32 vs int8")
+    args = parser.parse_args(argv)
+
+    images = _load_images(args.images, args.limit)
+    if not images:
+        parser.error(f"no readable images under {args.images}")
+    backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+    unknown = [b for b in backends if b not in ml_models.INFERENCE_BACKENDS]
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(unknown)}")
+
+    bench_clip(backends, images, DEFAULT_QUERIES, args.batch_size, args.repeats)
+    if args.captions:
+        bench_blip(images[: min(len(images), 16)], args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+"""Ingest/read throughput of the SQLite profiles in database.py, stdlib only
+
+    python bench_sqlite.py --rows 2000 --readers 4
+
+Each scenario inserts --rows image rows from one writer while --readers
+threads page through the gallery query, and reports writes/s and read latency.
+"""
+
+SCHEMA = [
+    """CREATE TABLE images (
+        id INTEGER PRIMARY KEY, s3_url TEXT NOT NULL, caption TEXT,
+        uploaded_at TIMESTAMP, filename TEXT NOT NULL
+    )""",
+    "CREATE INDEX ix_images_uploaded_at_id ON images (uploaded_at, id)",
+]
+
+LIST_SQL = (
+    "SELECT id, filename, caption, s3_url, uploaded_at FROM images "
+    "ORDER BY uploaded_at DESC, id DESC LIMIT 60"
+)
+
+# name, pragmas, writes per commit
+SCENARIOS = [
+    ("default (rollback journal, commit per row)", None, 1),
+    ("production pragmas, commit per row", "production", 1),
+    ("production pragmas + group commit", "production", 64),
+]
+
+PRODUCTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+]
+
+
+def _connect(path: str, profile) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    if profile == "production":
+        for pragma in PRODUCTION_PRAGMAS:
+            conn.execute(pragma)
+    return conn
+
+
+def _reader(path: str, profile, stop: threading.Event, latencies: list) -> None:
+    conn = _connect(path, profile)
+    try:
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn.execute(LIST_SQL).fetchall()
+            latencies.append((time.perf_counter() - started) * 1000.0)
+    finally:
+        conn.close()
+
+
+def run_scenario(name: str, profile, group: int, rows: int, readers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        conn = _connect(path, profile)
+        for statement in SCHEMA:
+            conn.execute(statement)
+        conn.commit()
+
+        stop = threading.Event()
+        latencies = [[] for _ in range(readers)]
+        threads = [
+            threading.Thread(target=_reader, args=(path, profile, stop, latencies[i]), daemon=True)
+            for i in range(readers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        base = datetime(2024, 1, 1)
+        started = time.perf_counter()
+        for i in range(rows):
+            conn.execute(
+                "INSERT INTO images (s3_url, caption, uploaded_at, filename) VALUES (?, ?, ?, ?)",
+                (f"/uploads/{i}.jpg", f"caption {i}", base + timedelta(seconds=i), f"{i}.jpg"),
+            )
+            if (i + 1) % group == 0:
+                conn.commit()
+        conn.commit()
+        elapsed = time.perf_counter() - started
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+        conn.close()
+
+    reads = sorted(latency for per_thread in latencies for latency in per_thread)
+    return {
+        "scenario": name,
+        "writes_per_s": rows / elapsed,
+        "reads": len(reads),
+        "read_p50_ms": statistics.median(reads) if reads else 0.0,
+        "read_p99_ms": reads[int(len(reads) * 0.99) - 1] if reads else 0.0,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Compare ingest and read throughput of the SQLite profiles")
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    print(f"{args.rows} inserts, {args.readers} concurrent gallery readers")
+    print(f"{'scenario':48} {'writes/s':>10} {'reads':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, profile, group in SCENARIOS:
+        r = run_scenario(name, profile, group, args.rows, args.readers)
+        print(
+            f"{r['scenario']:48} {r['writes_per_s']:10.0f} {r['reads']:8d} "
+            f"{r['read_p50_ms']:8.2f} {r['read_p99_ms']:8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
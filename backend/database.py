@@ -1,4 +1,5 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime
+from sqlalchemy import create_engine, event, inspect, Column, Integer, String, DateTime, Index, func
+import logging
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
 import os
@@ -11,6 +12,8 @@ from dotenv import load_dotenv
 # Load environment variables (useful for local dev outside Docker)
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 Base = declarative_base()
 
 
@@ -29,14 +32,57 @@ def _get_database_url() -> str:
     return _resolve_sqlite_url()
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
 # Create engine/session using env or sensible SQLite default
 DATABASE_URL = _get_database_url()
 is_sqlite = DATABASE_URL.startswith("sqlite:")
 connect_args = {"check_same_thread": False} if is_sqlite else {}
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+if is_sqlite:
+    # Seconds a connection waits on a locked database before raising
+    connect_args["timeout"] = _env_int("SQLITE_BUSY_TIMEOUT_MS", 5000) / 1000
+
+# production: WAL + tuned pragmas; default: SQLite's own settings (rollback journal)
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production").lower()
+
+pool_args = {}
+if ":memory:" not in DATABASE_URL:
+    # Readers (search hydration, listings) run concurrently under WAL; one writer at a time
+    pool_args = {
+        "pool_size": _env_int("DB_POOL_SIZE", 8),
+        "max_overflow": _env_int("DB_MAX_OVERFLOW", 16),
+        "pool_timeout": _env_int("DB_POOL_TIMEOUT_S", 30),
+    }
+engine = create_engine(DATABASE_URL, connect_args=connect_args, **pool_args)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
+@event.listens_for(engine, "connect")
+def _apply_sqlite_pragmas(dbapi_connection, _connection_record):
+    if not is_sqlite:
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout = {_env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)}")
+        if SQLITE_PROFILE != "production":
+            return
+        # Readers no longer block the writer (or each other) and commits are one fsync of the WAL
+        cursor.execute("PRAGMA journal_mode = WAL")
+        # Durable across app crashes; only an OS crash can lose the last commits
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute(f"PRAGMA mmap_size = {_env_int('SQLITE_MMAP_SIZE', 268435456)}")
+        # Negative = KiB, per connection
+        cursor.execute(f"PRAGMA cache_size = -{_env_int('SQLITE_CACHE_SIZE_KB', 65536)}")
+        cursor.execute("PRAGMA temp_store = MEMORY")
+    finally:
+        cursor.close()
+
+
 class Image(Base):
     """Image metadata model"""
     __tablename__ = "images"
@@ -46,6 +92,43 @@ class Image(Base):
     caption = Column(String, nullable=True)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     filename = Column(String, nullable=False)
+    # Hex SHA-256 of the original bytes (exact duplicates) and 64-bit dHash (near duplicates)
+    content_sha256 = Column(String(64), nullable=True)
+    phash = Column(String(16), nullable=True)
+    # Resized derivatives stored next to the original (see image_pipeline.DERIVATIVE_SIZES)
+    thumb_url = Column(String, nullable=True)
+    preview_url = Column(String, nullable=True)
+
+    __table_args__ = (
+        # Gallery order and keyset cursor: (uploaded_at, id) descending
+        Index("ix_images_uploaded_at_id", "uploaded_at", "id"),
+        Index("ix_images_content_sha256", "content_sha256"),
+        Index("ix_images_phash", "phash"),
+    )
+
+
+class TableCount(Base):
+    """Row counts maintained by triggers so listings never run COUNT(*)"""
+    __tablename__ = "table_counts"
+
+    name = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+
+class IngestJob(Base):
+    """Durable ingestion job; raw bytes stay spooled on disk until processed"""
+    __tablename__ = "ingest_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String, nullable=False, default="pending", index=True)
+    filename = Column(String, nullable=False)
+    spool_path = Column(String, nullable=False)
+    content_sha256 = Column(String(64), nullable=True, index=True)
+    image_id = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
 
 def get_db():
@@ -57,9 +140,166 @@ def get_db():
         db.close()
 
 
+# Set by init_db once the caption/filename full-text index is in place
+fts_enabled = False
+
+# External-content FTS5 index over images(caption, filename); triggers keep it in sync
+_FTS_STATEMENTS = [
+    """CREATE VIRTUAL TABLE images_fts USING fts5(
+        caption, filename, content='images', content_rowid='id', tokenize='porter unicode61'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS images_fts_ai AFTER INSERT ON images BEGIN
+        INSERT INTO images_fts(rowid, caption, filename) VALUES (new.id, new.caption, new.filename);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS images_fts_ad AFTER DELETE ON images BEGIN
+        INSERT INTO images_fts(images_fts, rowid, caption, filename)
+        VALUES ('delete', old.id, old.caption, old.filename);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS images_fts_au AFTER UPDATE OF caption, filename ON images BEGIN
+        INSERT INTO images_fts(images_fts, rowid, caption, filename)
+        VALUES ('delete', old.id, old.caption, old.filename);
+        INSERT INTO images_fts(rowid, caption, filename) VALUES (new.id, new.caption, new.filename);
+    END""",
+    # Index rows that existed before the table did
+    "INSERT INTO images_fts(images_fts) VALUES ('rebuild')",
+]
+
+
+# Trigger-maintained images row count, seeded from COUNT(*) in the same transaction
+_COUNT_STATEMENTS = [
+    """CREATE TRIGGER images_count_ai AFTER INSERT ON images BEGIN
+        UPDATE table_counts SET count = count + 1 WHERE name = 'images';
+    END""",
+    """CREATE TRIGGER images_count_ad AFTER DELETE ON images BEGIN
+        UPDATE table_counts SET count = count - 1 WHERE name = 'images';
+    END""",
+    "INSERT OR REPLACE INTO table_counts (name, count) SELECT 'images', COUNT(*) FROM images",
+]
+
+# Set by init_db once the triggers above exist
+counts_enabled = False
+
+# Bumped by any write that changes what caption/filename search can return, from
+# any process; caches of lexical results are keyed on it
+_CAPTION_GENERATION_STATEMENTS = [
+    "INSERT OR IGNORE INTO table_counts (name, count) VALUES ('images_text_generation', 0)",
+    """CREATE TRIGGER IF NOT EXISTS images_text_gen_ai AFTER INSERT ON images BEGIN
+        UPDATE table_counts SET count = count + 1 WHERE name = 'images_text_generation';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS images_text_gen_ad AFTER DELETE ON images BEGIN
+        UPDATE table_counts SET count = count + 1 WHERE name = 'images_text_generation';
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS images_text_gen_au AFTER UPDATE OF caption, filename ON images BEGIN
+        UPDATE table_counts SET count = count + 1 WHERE name = 'images_text_generation';
+    END""",
+]
+
+# Set by init_db once the triggers above exist
+caption_generation_enabled = False
+
+
+def _ensure_columns() -> None:
+    """create_all skips columns added to existing tables; ALTER TABLE in the nullable ones"""
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                logger.warning(f"Cannot add NOT NULL column {table.name}.{column.name} in place")
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            with engine.begin() as conn:
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+            logger.info(f"Added column {table.name}.{column.name}")
+
+
+def _ensure_indexes() -> None:
+    """create_all skips indexes on tables that already exist; add any that are missing"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+
+
+def _ensure_counters() -> bool:
+    if not is_sqlite:
+        return False
+    try:
+        with engine.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'images_count_ai'"
+            ).first()
+            if not exists:
+                for statement in _COUNT_STATEMENTS:
+                    conn.exec_driver_sql(statement)
+                logger.info("Created images row counter")
+        return True
+    except Exception as e:
+        logger.warning(f"Maintained image count unavailable: {e}")
+        return False
+
+
+def count_images(db) -> int:
+    """Number of images, from the maintained counter when available"""
+    if counts_enabled:
+        row = db.query(TableCount.count).filter(TableCount.name == "images").first()
+        if row is not None:
+            return row.count
+    return db.query(func.count(Image.id)).scalar()
+
+
+def _ensure_caption_generation() -> bool:
+    if not is_sqlite:
+        return False
+    try:
+        with engine.begin() as conn:
+            for statement in _CAPTION_GENERATION_STATEMENTS:
+                conn.exec_driver_sql(statement)
+        return True
+    except Exception as e:
+        logger.warning(f"Caption generation counter unavailable: {e}")
+        return False
+
+
+def caption_generation(db) -> Optional[int]:
+    """Changes so far to searchable captions/filenames; None when not tracked"""
+    if not caption_generation_enabled:
+        return None
+    row = db.query(TableCount.count).filter(TableCount.name == "images_text_generation").first()
+    return row.count if row is not None else None
+
+
+def _ensure_fts() -> bool:
+    """Create the FTS5 caption index on first run; False if SQLite lacks FTS5"""
+    if not is_sqlite:
+        return False
+    try:
+        with engine.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'images_fts'"
+            ).first()
+            if not exists:
+                for statement in _FTS_STATEMENTS:
+                    conn.exec_driver_sql(statement)
+                logger.info("Created images_fts full-text index")
+        return True
+    except Exception as e:
+        logger.warning(f"Full-text caption search unavailable: {e}")
+        return False
+
+
 async def init_db():
     """Initialize database tables"""
+    global fts_enabled, counts_enabled, caption_generation_enabled
     Base.metadata.create_all(bind=engine)
+    _ensure_columns()
+    _ensure_indexes()
+    counts_enabled = _ensure_counters()
+    fts_enabled = _ensure_fts()
+    caption_generation_enabled = _ensure_caption_generation()
     print("Database initialized successfully")
 
 
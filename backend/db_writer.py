@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+from database import SessionLocal
+
+"""Group-commit writer: many small write operations, one transaction and one fsync"""
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class GroupCommitWriter:
+    """Single writer thread that drains queued operations into shared commits
+
+    Each operation is a callable taking a Session (plus args). A group shares
+    one transaction; if anything in it fails, the group is replayed one commit
+    per operation so only the bad write errors. Futures resolve only after the
+    commit containing them succeeded. Operations may therefore run twice and
+    must not have side effects outside the session; return plain values, since
+    rows are expired on commit.
+    """
+
+    def __init__(self, max_batch: int = 64, max_wait_ms: int = 5):
+        self.max_batch = max(1, max_batch)
+        self.max_wait_ms = max(0, max_wait_ms)
+        self._queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.operations = 0
+        self.failed = 0
+        self.largest_group = 0
+
+    def _ensure_started(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._loop, name="db-group-commit", daemon=True)
+                self._thread.start()
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        self._ensure_started()
+        future: Future = Future()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Queue a write and wait until the commit that contains it is durable"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _collect(self, first: tuple) -> list:
+        group = [first]
+        deadline = time.monotonic() + self.max_wait_ms / 1000.0
+        while len(group) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # Stop after this group; put the sentinel back for the loop
+                self._queue.put(None)
+                break
+            group.append(item)
+        return group
+
+    def _loop(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            group = self._collect(first)
+            self._commit_group(group)
+
+    def _commit_group(self, group: list) -> None:
+        group = [item for item in group if item[3].set_running_or_notify_cancel()]
+        if not group:
+            return
+        db = SessionLocal()
+        try:
+            results = [fn(db, *args, **kwargs) for fn, args, kwargs, _ in group]
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            if len(group) == 1:
+                self.failed += 1
+                group[0][3].set_exception(e)
+                return
+            # Isolate the bad write: replay the group one commit at a time
+            logger.warning(f"Group commit of {len(group)} writes failed ({e}); retrying individually")
+            for item in group:
+                self._commit_group_single(item)
+            return
+        finally:
+            db.close()
+
+        self.commits += 1
+        self.operations += len(group)
+        self.largest_group = max(self.largest_group, len(group))
+        for (_, _, _, future), result in zip(group, results):
+            future.set_result(result)
+
+    def _commit_group_single(self, item: tuple) -> None:
+        fn, args, kwargs, future = item
+        db = SessionLocal()
+        try:
+            result = fn(db, *args, **kwargs)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.failed += 1
+            future.set_exception(e)
+            return
+        finally:
+            db.close()
+        self.commits += 1
+        self.operations += 1
+        future.set_result(result)
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Finish queued writes, then stop the writer thread"""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout=timeout)
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "max_batch": self.max_batch,
+            "max_wait_ms": self.max_wait_ms,
+            "commits": self.commits,
+            "operations": self.operations,
+            "failed": self.failed,
+            "avg_group_size": round(self.operations / self.commits, 2) if self.commits else 0.0,
+            "largest_group": self.largest_group,
+            "queued": self._queue.qsize(),
+        }
+
+
+db_writer = GroupCommitWriter(
+    max_batch=_env_int("DB_GROUP_COMMIT_MAX", 64),
+    max_wait_ms=_env_int("DB_GROUP_COMMIT_WAIT_MS", 5),
+)
@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import os
+import threading
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+
+from database import SessionLocal, Image, IngestJob
+
+"""Exact (SHA-256) and near (perceptual hash) duplicate detection for uploads"""
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+# Bits set in each byte value; popcount for numpy versions without bitwise_count
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _hamming(hashes: np.ndarray, target: int) -> np.ndarray:
+    xor = hashes ^ np.uint64(target)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(xor)
+    return _POPCOUNT8[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class Deduplicator:
+    """Finds earlier copies of an upload and counts the work that skipped
+
+    Exact duplicates are matched by content hash against stored images and
+    queued jobs, before anything is spooled. Near duplicates are matched by
+    Hamming distance between perceptual hashes, held in memory as a uint64
+    array (8 bytes per image) and scanned in one vectorized pass.
+    """
+
+    def __init__(self, exact: bool = True, near_distance: int = 0):
+        self.exact = exact
+        # Max differing dHash bits to treat two images as the same photo; 0 disables
+        self.near_distance = max(0, min(near_distance, 64))
+        self._lock = threading.Lock()
+        self._ids = np.empty(0, dtype=np.int64)
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.bytes_not_stored = 0
+        self.clip_skipped = 0
+        self.blip_skipped = 0
+
+    def load(self) -> int:
+        """Read every stored perceptual hash; returns how many were loaded"""
+        if self.near_distance == 0:
+            return 0
+        db = SessionLocal()
+        try:
+            rows = db.query(Image.id, Image.phash).filter(Image.phash.isnot(None)).all()
+        finally:
+            db.close()
+        ids = np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows))
+        hashes = np.fromiter((int(row.phash, 16) for row in rows), dtype=np.uint64, count=len(rows))
+        with self._lock:
+            self._ids, self._hashes = ids, hashes
+        logger.info(f"Loaded {len(rows)} perceptual hashes for near-duplicate detection")
+        return len(rows)
+
+    def add(self, entries: Iterable[Tuple[int, Optional[str]]]) -> None:
+        """Record (image_id, phash) of newly stored images"""
+        if self.near_distance == 0:
+            return
+        entries = [(image_id, phash) for image_id, phash in entries if phash]
+        if not entries:
+            return
+        ids = np.array([image_id for image_id, _ in entries], dtype=np.int64)
+        hashes = np.array([int(phash, 16) for _, phash in entries], dtype=np.uint64)
+        with self._lock:
+            keep = ~np.isin(self._ids, ids)
+            self._ids = np.concatenate([self._ids[keep], ids])
+            self._hashes = np.concatenate([self._hashes[keep], hashes])
+
+    def remove(self, image_ids: Iterable[int]) -> None:
+        if self.near_distance == 0:
+            return
+        with self._lock:
+            keep = ~np.isin(self._ids, np.fromiter(image_ids, dtype=np.int64))
+            self._ids, self._hashes = self._ids[keep], self._hashes[keep]
+
+    def find_stored(self, db, sha256: str) -> Optional[int]:
+        """Id of an image with exactly these bytes, if one is stored"""
+        if not self.exact:
+            return None
+        row = db.query(Image.id).filter(Image.content_sha256 == sha256).order_by(Image.id).first()
+        return row.id if row is not None else None
+
+    def find_queued(self, db, sha256: str) -> Optional[IngestJob]:
+        """Oldest pending or processing job for exactly these bytes, if any"""
+        if not self.exact:
+            return None
+        return (
+            db.query(IngestJob)
+            .filter(IngestJob.content_sha256 == sha256, IngestJob.status.in_(("pending", "processing")))
+            .order_by(IngestJob.id)
+            .first()
+        )
+
+    def find_near(self, phash: Optional[str]) -> Optional[int]:
+        """Id of the closest stored image within near_distance bits, if any"""
+        if self.near_distance == 0 or not phash:
+            return None
+        with self._lock:
+            if len(self._hashes) == 0:
+                return None
+            distances = _hamming(self._hashes, int(phash, 16))
+            best = int(np.argmin(distances))
+            if int(distances[best]) > self.near_distance:
+                return None
+            return int(self._ids[best])
+
+    def record_exact(self, size: int) -> None:
+        """An upload answered with an existing image: no storage write, CLIP or BLIP"""
+        with self._lock:
+            self.exact_hits += 1
+            self.bytes_not_stored += size
+            self.clip_skipped += 1
+            self.blip_skipped += 1
+
+    def record_near(self) -> None:
+        """An upload stored with a copied vector and caption: no CLIP or BLIP"""
+        with self._lock:
+            self.near_hits += 1
+            self.clip_skipped += 1
+            self.blip_skipped += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "exact_enabled": self.exact,
+                "near_distance": self.near_distance,
+                "hashes_loaded": int(len(self._hashes)),
+                "exact_hits": self.exact_hits,
+                "near_hits": self.near_hits,
+                "bytes_not_stored": self.bytes_not_stored,
+                "clip_skipped": self.clip_skipped,
+                "blip_skipped": self.blip_skipped,
+            }
+
+
+dedup = Deduplicator(
+    exact=os.getenv("DEDUP_EXACT", "true").lower() in ("1", "true", "yes"),
+    near_distance=_env_int("DEDUP_NEAR_DISTANCE", 0),
+)
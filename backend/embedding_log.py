@@ -0,0 +1,140 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+"""Append-only, fsynced log of index mutations replayed on top of the last snapshot"""
+
+logger = logging.getLogger(__name__)
+
+OP_ADD = 1
+OP_REMOVE = 2
+
+# op (uint8), image id (int64), payload length in bytes (uint32); then payload, then crc32
+_HEADER = struct.Struct("<BqI")
+_CRC = struct.Struct("<I")
+
+
+class EmbeddingLog:
+    """Durable record of every add/remove since the last index snapshot"""
+
+    def __init__(self, path: str, embedding_dim: int):
+        self.path = path
+        self.rotated_path = path + ".1"
+        self.embedding_dim = embedding_dim
+        self._lock = threading.Lock()
+        self._file = None
+        self.records = 0
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "ab")
+        return self._file
+
+    @staticmethod
+    def _encode(op: int, image_id: int, payload: bytes) -> bytes:
+        header = _HEADER.pack(op, int(image_id), len(payload))
+        crc = zlib.crc32(payload, zlib.crc32(header))
+        return header + payload + _CRC.pack(crc)
+
+    def _append(self, blob: bytes, count: int) -> None:
+        with self._lock:
+            f = self._open()
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+            self.records += count
+
+    def append_adds(self, image_ids: List[int], vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype='float32')
+        blob = b"".join(
+            self._encode(OP_ADD, image_id, vector.tobytes())
+            for image_id, vector in zip(image_ids, vectors)
+        )
+        self._append(blob, len(image_ids))
+
+    def append_removes(self, image_ids: List[int]) -> None:
+        blob = b"".join(self._encode(OP_REMOVE, image_id, b"") for image_id in image_ids)
+        self._append(blob, len(image_ids))
+
+    def size_bytes(self) -> int:
+        total = 0
+        for path in (self.path, self.rotated_path):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def rotate(self) -> None:
+        """Move current records aside so a snapshot can be written without blocking appends"""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not os.path.exists(self.path):
+                return
+            if os.path.exists(self.rotated_path):
+                # A previous snapshot never completed; keep its records in front of ours
+                with open(self.rotated_path, "ab") as dst, open(self.path, "rb") as src:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self.path)
+            else:
+                os.replace(self.path, self.rotated_path)
+            self.records = 0
+
+    def discard_rotated(self) -> None:
+        """Drop rotated records once the snapshot that contains them is on disk"""
+        if os.path.exists(self.rotated_path):
+            os.remove(self.rotated_path)
+
+    def _read(self, path: str) -> Iterator[Tuple[int, int, Optional[np.ndarray]]]:
+        vector_bytes = self.embedding_dim * 4
+        with open(path, "rb") as f:
+            data = f.read()
+        offset = 0
+        while offset + _HEADER.size <= len(data):
+            op, image_id, length = _HEADER.unpack_from(data, offset)
+            end = offset + _HEADER.size + length + _CRC.size
+            if end > len(data) or op not in (OP_ADD, OP_REMOVE):
+                break
+            payload = data[offset + _HEADER.size: offset + _HEADER.size + length]
+            (crc,) = _CRC.unpack_from(data, end - _CRC.size)
+            if crc != zlib.crc32(payload, zlib.crc32(data[offset: offset + _HEADER.size])):
+                break
+            if op == OP_ADD and length != vector_bytes:
+                break
+            vector = np.frombuffer(payload, dtype='float32') if op == OP_ADD else None
+            yield op, image_id, vector
+            offset = end
+
+        if offset < len(data):
+            # Torn write from a crash mid-append; everything before it is intact
+            logger.warning(f"Truncating {len(data) - offset} trailing bytes of embedding log {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+    def replay(self) -> Dict[int, Optional[np.ndarray]]:
+        """Net effect of all logged records: id -> final vector, or None if removed"""
+        final: Dict[int, Optional[np.ndarray]] = {}
+        count = 0
+        for path in (self.rotated_path, self.path):
+            if not os.path.exists(path):
+                continue
+            for op, image_id, vector in self._read(path):
+                final[image_id] = vector
+                count += 1
+        with self._lock:
+            self.records = count
+        return final
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+
+"""Columnar float16 store of every image's embedding, addressed directly by Image.id"""
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """Row i of a float16 .npy memmap holds the embedding of image id i
+
+    A parallel uint8 mask marks which rows are present. Ids are SQLite
+    autoincrement keys, so direct addressing stays dense and lookups are a
+    single fancy-index instead of a search.
+    """
+
+    def __init__(self, path: str, embedding_dim: int, read_only: bool = False):
+        self.path = path
+        self.mask_path = os.path.splitext(path)[0] + ".present.npy"
+        self.embedding_dim = embedding_dim
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        self._vectors: Optional[np.memmap] = None
+        self._present: Optional[np.memmap] = None
+        self._count: Optional[int] = None
+
+    def _open(self) -> bool:
+        if self._vectors is not None:
+            return True
+        if not os.path.exists(self.path) or not os.path.exists(self.mask_path):
+            return False
+        mode = "r" if self.read_only else "r+"
+        vectors = np.load(self.path, mmap_mode=mode)
+        present = np.load(self.mask_path, mmap_mode=mode)
+        if vectors.shape[1:] != (self.embedding_dim,) or len(present) != len(vectors):
+            logger.error(f"Embedding store {self.path} has an unexpected shape {vectors.shape}; ignoring it")
+            return False
+        self._vectors, self._present = vectors, present
+        self._count = None
+        return True
+
+    @property
+    def capacity(self) -> int:
+        with self._lock:
+            return len(self._vectors) if self._open() else 0
+
+    @property
+    def count(self) -> int:
+        with self._lock:
+            if not self._open():
+                return 0
+            if self._count is None:
+                self._count = int(np.count_nonzero(self._present))
+            return self._count
+
+    def _ensure_capacity(self, max_id: int) -> None:
+        needed = max_id + 1
+        if self._open() and len(self._vectors) >= needed:
+            return
+        old = len(self._vectors) if self._vectors is not None else 0
+        capacity = max(1024, needed, 2 * old)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        # Grow into fresh files and rename over the old ones; readers that still
+        # map the previous files keep a consistent (if shorter) view
+        tmp_vectors, tmp_mask = self.path + ".tmp", self.mask_path + ".tmp"
+        vectors = np.lib.format.open_memmap(
+            tmp_vectors, mode="w+", dtype=np.float16, shape=(capacity, self.embedding_dim)
+        )
+        present = np.lib.format.open_memmap(tmp_mask, mode="w+", dtype=np.uint8, shape=(capacity,))
+        if old:
+            vectors[:old] = self._vectors
+            present[:old] = self._present
+        vectors.flush()
+        present.flush()
+        del vectors, present
+        self._vectors = self._present = None
+        os.replace(tmp_vectors, self.path)
+        os.replace(tmp_mask, self.mask_path)
+        self._open()
+        logger.info(f"Grew embedding store to {capacity} rows")
+
+    def put(self, image_ids, vectors: np.ndarray) -> None:
+        """Insert or overwrite embeddings for these ids"""
+        if self.read_only:
+            raise RuntimeError("Embedding store is read-only")
+        ids = np.asarray(image_ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        if ids.min() < 0:
+            raise ValueError("Embedding store ids must be non-negative")
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), self.embedding_dim)
+        with self._lock:
+            self._ensure_capacity(int(ids.max()))
+            self._vectors[ids] = vectors.astype(np.float16)
+            self._present[ids] = 1
+            self._vectors.flush()
+            self._present.flush()
+            self._count = None
+
+    def delete(self, image_ids) -> None:
+        if self.read_only:
+            raise RuntimeError("Embedding store is read-only")
+        ids = np.asarray(image_ids, dtype=np.int64)
+        with self._lock:
+            if len(ids) == 0 or not self._open():
+                return
+            ids = ids[(ids >= 0) & (ids < len(self._present))]
+            self._present[ids] = 0
+            self._present.flush()
+            self._count = None
+
+    def get(self, image_ids) -> Tuple[np.ndarray, np.ndarray]:
+        """float32 vectors for these ids (zero rows where missing) and a found mask"""
+        ids = np.asarray(image_ids, dtype=np.int64)
+        vectors = np.zeros((len(ids), self.embedding_dim), dtype=np.float32)
+        found = np.zeros(len(ids), dtype=bool)
+        with self._lock:
+            if len(ids) == 0 or not self._open():
+                return vectors, found
+            in_range = (ids >= 0) & (ids < len(self._present))
+            rows = ids[in_range]
+            found[in_range] = self._present[rows].astype(bool)
+            vectors[found] = self._vectors[ids[found]]
+        return vectors, found
+
+    def ids(self) -> np.ndarray:
+        """Every stored id, in order"""
+        with self._lock:
+            if not self._open():
+                return np.empty(0, dtype=np.int64)
+            return np.flatnonzero(self._present).astype(np.int64)
+
+    def all(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Every stored (ids, float32 vectors) pair, in id order"""
+        with self._lock:
+            if not self._open():
+                return np.empty(0, dtype=np.int64), np.empty((0, self.embedding_dim), dtype=np.float32)
+            ids = np.flatnonzero(self._present).astype(np.int64)
+            return ids, np.asarray(self._vectors[ids], dtype=np.float32)
+
+    def reload(self) -> None:
+        """Re-map the files, e.g. after a writer process grew them"""
+        with self._lock:
+            self._vectors = self._present = None
+            self._open()
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "vectors": self.count,
+            "capacity": self.capacity,
+            "bytes": os.path.getsize(self.path) if os.path.exists(self.path) else 0,
+        }
@@ -1,16 +1,35 @@
 import faiss
 import numpy as np
-import pickle
+import glob
 import os
 import logging
+import threading
+import time
+import zlib
 from typing import List, Tuple, Optional
 
 from dotenv import load_dotenv
 
+from embedding_log import EmbeddingLog
+from embedding_store import EmbeddingStore
+import storage
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# flat: exact brute force; hnsw: graph ANN; ivf/ivfpq: trained inverted lists;
+# auto: flat until FAISS_ANN_THRESHOLD vectors, then FAISS_AUTO_INDEX_TYPE
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq", "auto")
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
 class FAISSManager:
     """Manages FAISS vector index for semantic image search"""
 
@@ -19,41 +38,125 @@ class FAISSManager:
         embedding_dim: int = 512,
         index_path: str = "./faiss_index.index",
         s3_key: Optional[str] = None,
+        index_type: Optional[str] = None,
+        store_path: Optional[str] = None,
+        load_mode: Optional[str] = None,
     ):
         self.embedding_dim = embedding_dim  # CLIP ViT-B-32 uses 512 dimensions
         self.index_path = index_path
+        # IndexIDMap2 around the actual search index; FAISS ids are database Image ids
         self.index = None
-        self.image_ids = []  # Maps FAISS index positions to database IDs
         self.s3_key = s3_key or os.getenv("S3_FAISS_KEY")
+        # Ingestion adds from a worker thread while searches read the index
+        self._lock = threading.RLock()
+        # Bumped on every change to the index contents; used to invalidate cached results
+        self.version = 0
+
+        self.index_type = (index_type or os.getenv("FAISS_INDEX_TYPE", "auto")).lower()
+        if self.index_type not in INDEX_TYPES:
+            logger.warning(f"Unknown FAISS_INDEX_TYPE '{self.index_type}', using 'auto'")
+            self.index_type = "auto"
+        self.auto_index_type = os.getenv("FAISS_AUTO_INDEX_TYPE", "hnsw").lower()
+        if self.auto_index_type not in ("hnsw", "ivf", "ivfpq"):
+            self.auto_index_type = "hnsw"
+        self.ann_threshold = _env_int("FAISS_ANN_THRESHOLD", 50000)
+        self.hnsw_m = _env_int("FAISS_HNSW_M", 32)
+        self.hnsw_ef_construction = _env_int("FAISS_HNSW_EF_CONSTRUCTION", 80)
+        self.hnsw_ef_search = _env_int("FAISS_HNSW_EF_SEARCH", 64)
+        self.ivf_nlist = _env_int("FAISS_IVF_NLIST", 0)  # 0 = ~4*sqrt(n) at train time
+        self.ivf_nprobe = _env_int("FAISS_IVF_NPROBE", 16)
+        self.pq_m = _env_int("FAISS_PQ_M", 64)  # sub-quantizers; must divide embedding_dim
+        self.train_sample = _env_int("FAISS_TRAIN_SAMPLE", 100000)
+
+        self._rebuild_thread: Optional[threading.Thread] = None
+        self._trained_ntotal = 0  # ntotal when an IVF index was last trained
+        self.last_recall: Optional[dict] = None
+
+        # Storage positions of deleted vectors in indexes that can't remove cheaply;
+        # filtered at query time until a compaction rebuild drops them
+        self._tombstones = np.zeros(0, dtype=bool)
+        self._dead = 0
+        # (version, ntotal, packed live-position bitmap, selector) for in-FAISS filtering
+        self._live_selector = None
+        try:
+            self.compact_ratio = float(os.getenv("FAISS_COMPACT_RATIO", "0.1"))
+        except ValueError:
+            self.compact_ratio = 0.1
+
+        # Every mutation is fsynced to the log; full snapshots (and S3 uploads) happen
+        # in the background once enough records pile up or the interval passes
+        self.log = EmbeddingLog(self.index_path + ".log", embedding_dim)
+        self.snapshot_records = _env_int("FAISS_SNAPSHOT_RECORDS", 1000)
+        self.snapshot_interval = _env_int("FAISS_SNAPSHOT_INTERVAL_S", 300)
+        self.last_snapshot_at: Optional[float] = None
+        self._snapshot_lock = threading.Lock()
+        self._snapshot_wake = threading.Event()
+        self._snapshot_stop = threading.Event()
+        self._snapshot_thread: Optional[threading.Thread] = None
+
+        # mmap: map the snapshot read-only so workers on a host share page cache and
+        # start almost instantly; such replicas never write and just follow new snapshots
+        self.load_mode = (load_mode or os.getenv("FAISS_LOAD_MODE", "memory")).lower()
+        self.read_only = self.load_mode == "mmap"
+        self.reload_interval = _env_int("FAISS_RELOAD_INTERVAL_S", 60)
+        self.load_seconds: Optional[float] = None
+        # Completed load_index calls; a change tells caches keyed on the loaded index to drop
+        self.loads = 0
+        # What the last load actually mapped: "all", "inverted_lists" or None (read into RAM)
+        self.mapped: Optional[str] = None
+        self._loaded_mtime: Optional[int] = None
+
+        # Exact copy of every indexed vector keyed by image id, so rebuilds and
+        # similarity lookups never need the model or a lossy reconstruct
+        store_path = store_path or os.getenv("EMBEDDING_STORE_PATH") or os.path.splitext(index_path)[0] + ".embeddings.npy"
+        self.store = EmbeddingStore(store_path, embedding_dim, read_only=self.read_only)
         
     def initialize_index(self):
         """Create a new FAISS index or load existing one"""
         try:
             if os.path.exists(self.index_path):
-                self.load_index()
-                logger.info(f"Loaded existing FAISS index with {self.index.ntotal} vectors")
+                if self.load_index():
+                    logger.info(f"Loaded existing FAISS index with {self.index.ntotal} vectors")
             else:
                 # Try load from S3 if configured
-                if self.s3_key:
-                    try:
-                        from . import s3_manager  # relative import if used as package
-                    except Exception:
-                        import s3_manager  # fallback for module path
-                    if s3_manager.is_configured() and s3_manager.object_exists(self.s3_key):
-                        mapping_path = self.index_path + ".mapping"
-                        s3_manager.download_file(self.s3_key, self.index_path)
-                        s3_manager.download_file(self.s3_key + ".mapping", mapping_path)
+                remote = storage.s3_storage
+                if self.s3_key and remote is not None:
+                    if remote.exists(self.s3_key):
+                        remote.get_file(self.s3_key, self.index_path)
+                        # Older uploads kept ids in a pickled sidecar; fetch it for migration
+                        legacy_mapping = self.s3_key + ".mapping"
+                        if remote.exists(legacy_mapping):
+                            remote.get_file(legacy_mapping, self.index_path + ".mapping")
                         if os.path.exists(self.index_path):
                             self.load_index()
                             logger.info(
                                 f"Downloaded FAISS index from S3 and loaded with {self.index.ntotal} vectors"
                             )
-                            return True
-                # Create new IndexFlatIP (Inner Product for cosine similarity)
-                self.index = faiss.IndexFlatIP(self.embedding_dim)
-                self.image_ids = []
-                logger.info("Created new FAISS IndexFlatIP")
+
+            recovered = False
+            if self.index is None and not self.read_only and self.store.count > 0:
+                # Snapshot missing or unreadable: rebuild from stored vectors instead of re-embedding
+                logger.warning(f"No usable FAISS snapshot; rebuilding from {self.store.count} stored embeddings")
+                recovered = self.rebuild_from_store(persist=False)
+            if self.index is None:
+                # Create new index (Inner Product for cosine similarity)
+                self.index = self._make_empty_index()
+                self.version += 1
+                logger.info(f"Created new FAISS {self.active_index_type} index")
                 
+            if self.read_only:
+                # Writers own the log; follow the snapshots they publish instead
+                self._start_reloader()
+                return True
+
+            # Bring the snapshot up to date with everything logged since it was written
+            self._replay_log()
+            self._backfill_store()
+            if recovered:
+                self.save_index()
+            self._start_snapshotter()
+            # Switch index type in the background if the configured policy asks for it
+            self.maybe_rebuild()
             return True
             
         except Exception as e:
@@ -71,17 +174,186 @@ class FAISSManager:
             embedding = embedding.reshape(1, -1).astype('float32')
             faiss.normalize_L2(embedding)
             
-            # Add to index
-            self.index.add(embedding)
-            self.image_ids.append(image_id)
+            # Add to index under its database id
+            self._add_normalized(embedding, np.array([image_id], dtype='int64'))
             
             logger.debug(f"Added embedding for image_id {image_id}")
+            self.maybe_rebuild()
+            self.maybe_snapshot()
             return True
             
         except Exception as e:
             logger.error(f"Failed to add embedding for image_id {image_id}: {e}")
             return False
     
+    def add_embeddings(self, embeddings: np.ndarray, image_ids: List[int]):
+        """Add a batch of image embeddings to the index in one call"""
+        if self.index is None:
+            logger.error("FAISS index not initialized")
+            return False
+        if len(image_ids) == 0:
+            return True
+
+        try:
+            embeddings = np.ascontiguousarray(embeddings, dtype='float32').reshape(len(image_ids), -1)
+            faiss.normalize_L2(embeddings)
+
+            self._add_normalized(embeddings, np.asarray(image_ids, dtype='int64'))
+
+            logger.debug(f"Added {len(image_ids)} embeddings")
+            self.maybe_rebuild()
+            self.maybe_snapshot()
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to add batch of {len(image_ids)} embeddings: {e}")
+            return False
+
+    def _add_normalized(self, vectors: np.ndarray, ids: np.ndarray, log: bool = True) -> None:
+        if self.read_only:
+            raise RuntimeError("FAISS index is loaded read-only (FAISS_LOAD_MODE=mmap)")
+        with self._lock:
+            # Write-ahead: the vector is durable before it becomes searchable
+            if log:
+                self.log.append_adds(ids.tolist(), vectors)
+            self.store.put(ids, vectors)
+            self.index.add_with_ids(vectors, ids)
+            self.version += 1
+
+    def remove_embeddings(self, image_ids: List[int]) -> int:
+        """Remove vectors for these image ids; returns how many vectors were dropped"""
+        if self.index is None:
+            logger.error("FAISS index not initialized")
+            return 0
+        if len(image_ids) == 0:
+            return 0
+
+        try:
+            removed = self._remove(image_ids)
+            logger.debug(f"Removed {removed} vectors for image_ids {list(image_ids)}")
+            self.maybe_rebuild()
+            self.maybe_snapshot()
+            return removed
+
+        except Exception as e:
+            logger.error(f"Failed to remove embeddings for image_ids {list(image_ids)}: {e}")
+            return 0
+
+    def _remove(self, image_ids: List[int], log: bool = True) -> int:
+        if self.read_only:
+            raise RuntimeError("FAISS index is loaded read-only (FAISS_LOAD_MODE=mmap)")
+        with self._lock:
+            self.store.delete(image_ids)
+            all_ids = self._ids(self.index)
+            positions = np.flatnonzero(np.isin(all_ids, np.asarray(image_ids, dtype='int64')))
+            positions = positions[~self._dead_mask(positions)]
+            if len(positions) == 0:
+                return 0
+            if log:
+                self.log.append_removes(list(image_ids))
+
+            # Flat storage compacts in place; everything else (and anything while a
+            # rebuild holds a positional snapshot) gets tombstoned instead
+            if self.active_index_type == "flat" and self._dead == 0 and not self.rebuilding:
+                removed = int(self.index.remove_ids(np.asarray(image_ids, dtype='int64')))
+            else:
+                self._grow_tombstones(int(self.index.ntotal))
+                self._tombstones[positions] = True
+                self._dead += len(positions)
+                removed = len(positions)
+            self.version += 1
+            return removed
+
+    def _replay_log(self) -> None:
+        """Apply logged adds/removes on top of the loaded snapshot (idempotent upserts)"""
+        final = self.log.replay()
+        if not final:
+            return
+        ids = np.fromiter(final.keys(), dtype='int64', count=len(final))
+        with self._lock:
+            # An id already in the snapshot is replaced, so replaying twice is harmless
+            present = ids[np.isin(ids, self._ids(self.index))]
+            if len(present):
+                self._remove(present.tolist(), log=False)
+            add_ids = np.array([i for i, v in final.items() if v is not None], dtype='int64')
+            self.store.delete([i for i, v in final.items() if v is None])
+            if len(add_ids):
+                vectors = np.stack([final[int(i)] for i in add_ids])
+                self._add_normalized(vectors, add_ids, log=False)
+        logger.info(
+            f"Replayed embedding log: {len(add_ids)} upserts, "
+            f"{len(final) - len(add_ids)} removals on top of snapshot"
+        )
+
+    def get_embeddings(self, image_ids: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """Stored (normalized) vectors for these ids and a mask of which were found"""
+        return self.store.get(image_ids)
+
+    def replace_embedding(self, embedding: np.ndarray, image_id: int) -> bool:
+        """Swap the stored vector for an image (e.g. after re-embedding)"""
+        with self._lock:
+            self.remove_embeddings([image_id])
+            return self.add_embedding(embedding, image_id)
+
+    def _grow_tombstones(self, n: int) -> None:
+        if len(self._tombstones) < n:
+            grown = np.zeros(max(n, 2 * len(self._tombstones)), dtype=bool)
+            grown[:len(self._tombstones)] = self._tombstones
+            self._tombstones = grown
+
+    def _dead_mask(self, positions: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(positions), dtype=bool)
+        in_range = positions < len(self._tombstones)
+        mask[in_range] = self._tombstones[positions[in_range]]
+        return mask
+
+    def _search_params(self, base, ntotal: int):
+        """SearchParameters that make FAISS skip tombstoned positions itself, or None
+
+        The selector is a bitmap of live storage positions, rebuilt only when
+        the index changes; the parameter type must match the index (HNSW/IVF
+        reject the generic one), so their search settings are carried over.
+        """
+        if self._dead == 0:
+            return None
+        cached = self._live_selector
+        if cached is None or cached[0] != self.version or cached[1] != ntotal:
+            live = np.ones(ntotal, dtype=bool)
+            live[:min(ntotal, len(self._tombstones))] = ~self._tombstones[:ntotal]
+            bitmap = np.packbits(live, bitorder="little")
+            # The selector reads the numpy buffer directly, so both are kept together
+            cached = (self.version, ntotal, bitmap, faiss.IDSelectorBitmap(ntotal, faiss.swig_ptr(bitmap)))
+            self._live_selector = cached
+        selector = cached[3]
+        if isinstance(base, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=base.hnsw.efSearch)
+        if isinstance(base, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=base.nprobe)
+        return faiss.SearchParameters(sel=selector)
+
+    def _search_batch(self, queries: np.ndarray, top_k: int) -> List[List[Tuple[int, float]]]:
+        """k-NN for normalized queries; tombstoned vectors are filtered inside FAISS"""
+        with self._lock:
+            ntotal = int(self.index.ntotal)
+            if ntotal == 0 or top_k <= 0:
+                return [[] for _ in range(len(queries))]
+            base = self._base(self.index)
+            params = self._search_params(base, ntotal)
+            k = min(top_k, ntotal)
+            if params is None:
+                scores, positions = base.search(queries, k)
+            else:
+                scores, positions = base.search(queries, k, params=params)
+
+            results = []
+            for row_scores, row_positions in zip(scores, positions):
+                valid = row_positions >= 0
+                results.append([
+                    (int(self.index.id_map.at(int(pos))), float(score))
+                    for score, pos in zip(row_scores[valid], row_positions[valid])
+                ])
+            return results
+
     def search(self, query_embedding: np.ndarray, top_k: int = 5) -> List[Tuple[int, float]]:
         """Search for most similar images"""
         if self.index is None:
@@ -93,73 +365,577 @@ class FAISSManager:
             query_embedding = query_embedding.reshape(1, -1).astype('float32')
             faiss.normalize_L2(query_embedding)
             
-            # Search index
-            scores, indices = self.index.search(query_embedding, top_k)
-            
-            # Map FAISS indices back to database IDs
-            results = []
-            for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-                if idx < len(self.image_ids):  # Valid index
-                    image_id = self.image_ids[idx]
-                    results.append((image_id, float(score)))
-            
-            return results
+            # Search index; results carry database IDs
+            return self._search_batch(query_embedding, top_k)[0]
             
         except Exception as e:
             logger.error(f"FAISS search failed: {e}")
             return []
+
+    def search_similar(self, image_ids: List[int], top_k: int = 10) -> List[Optional[List[Tuple[int, float]]]]:
+        """Neighbours of already-indexed images in one multi-query search
+
+        Query vectors come from the embedding store (falling back to the index),
+        so no model is involved. Each image is left out of its own results;
+        ids that aren't indexed get None.
+        """
+        if self.index is None:
+            logger.error("FAISS index not initialized")
+            return [None] * len(image_ids)
+        if len(image_ids) == 0:
+            return []
+
+        try:
+            ids = np.asarray(image_ids, dtype='int64')
+            with self._lock:
+                all_ids = self._ids(self.index)
+                positions = np.flatnonzero(np.isin(all_ids, ids))
+                positions = positions[~self._dead_mask(positions)]
+                position_of = dict(zip(all_ids[positions].tolist(), positions.tolist()))
+                indexed = np.array([int(i) in position_of for i in ids], dtype=bool)
+                queries, found = self.store.get(ids)
+                # Vectors that predate the store are read back out of the index
+                fallback = np.flatnonzero(indexed & ~found)
+                if len(fallback):
+                    positions = np.array([position_of[int(i)] for i in ids[fallback]], dtype='int64')
+                    queries[fallback] = self._reconstruct_at(self.index, positions)
+
+            results: List[Optional[List[Tuple[int, float]]]] = [None] * len(ids)
+            rows = np.flatnonzero(indexed)
+            if len(rows):
+                queries = np.ascontiguousarray(queries[rows])
+                faiss.normalize_L2(queries)
+                # One extra neighbour because the query image finds itself
+                hits = self._search_batch(queries, top_k + 1)
+                for row, row_hits in zip(rows, hits):
+                    own_id = int(ids[row])
+                    results[row] = [(i, score) for i, score in row_hits if i != own_id][:top_k]
+            return results
+
+        except Exception as e:
+            logger.error(f"Similarity search failed for image_ids {list(image_ids)}: {e}")
+            return [None] * len(image_ids)
+
+    @property
+    def tombstones(self) -> int:
+        return self._dead
     
     def save_index(self):
-        """Save FAISS index and ID mapping to disk"""
-        if self.index is None:
+        """Write a full snapshot (ids included), fold the log into it and push to S3"""
+        if self.index is None or self.read_only:
             return False
             
-        try:
-            # Save FAISS index
-            faiss.write_index(self.index, self.index_path)
-            
-            # Save ID mapping
-            mapping_path = self.index_path + ".mapping"
-            with open(mapping_path, 'wb') as f:
-                pickle.dump(self.image_ids, f)
-                
-            logger.info(f"Saved FAISS index with {len(self.image_ids)} vectors")
+        with self._snapshot_lock:
+            try:
+                # Serialize in memory and rotate the log under the lock; the slow
+                # disk write and S3 upload happen without blocking searches or adds
+                with self._lock:
+                    data = faiss.serialize_index(self.index)
+                    ntotal = int(self.index.ntotal)
+                    dead_positions = np.flatnonzero(self._tombstones[:ntotal])
+                    tombstones_path = self._tombstones_path(self._ids(self.index))
+                    self.log.rotate()
+
+                # Tombstones are storage positions; the file is named after the snapshot's
+                # id layout so a crash between the two renames can't pair mismatched files
+                if len(dead_positions):
+                    with open(tombstones_path + ".tmp", 'wb') as f:
+                        np.save(f, dead_positions)
+                    os.replace(tombstones_path + ".tmp", tombstones_path)
+
+                # Write to a temp file and rename so readers never see a partial index
+                tmp_path = self.index_path + ".tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.index_path)
+
+                # Records up to the rotation are now in the snapshot
+                self.log.discard_rotated()
+                for stale in glob.glob(glob.escape(self.index_path) + ".tombstones.*.npy"):
+                    if stale != tombstones_path or not len(dead_positions):
+                        os.remove(stale)
+                self.last_snapshot_at = time.time()
+                    
+                logger.info(f"Saved FAISS index snapshot with {ntotal} vectors")
+
+            except Exception as e:
+                logger.error(f"Failed to save FAISS index: {e}")
+                return False
 
             # Optionally push to S3
-            if self.s3_key:
+            if self.s3_key and storage.s3_storage is not None:
                 try:
-                    try:
-                        from . import s3_manager
-                    except Exception:
-                        import s3_manager
-                    if s3_manager.is_configured():
-                        s3_manager.upload_file(self.s3_key, self.index_path, public=False)
-                        s3_manager.upload_file(self.s3_key + ".mapping", mapping_path, public=False)
-                        logger.info("Uploaded FAISS index to S3")
+                    # Multipart with parts in flight concurrently for large snapshots
+                    storage.s3_storage.put_file(self.s3_key, self.index_path, public=False)
+                    logger.info("Uploaded FAISS index to S3")
                 except Exception as e:
                     logger.warning(f"Failed to upload FAISS index to S3: {e}")
             return True
-            
-        except Exception as e:
-            logger.error(f"Failed to save FAISS index: {e}")
-            return False
+
+    def _tombstones_path(self, ids: np.ndarray) -> str:
+        layout = zlib.crc32(np.ascontiguousarray(ids, dtype='int64').tobytes())
+        return f"{self.index_path}.tombstones.{len(ids)}-{layout:08x}.npy"
+
+    def maybe_snapshot(self) -> None:
+        """Ask the background snapshotter to run if the log has grown large"""
+        if self.log.records >= self.snapshot_records:
+            self._snapshot_wake.set()
+
+    def _start_snapshotter(self) -> None:
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        self._snapshot_stop.clear()
+        self._snapshot_thread = threading.Thread(
+            target=self._snapshot_loop, name="faiss-snapshot", daemon=True
+        )
+        self._snapshot_thread.start()
+
+    def _snapshot_loop(self) -> None:
+        while not self._snapshot_stop.is_set():
+            self._snapshot_wake.wait(timeout=self.snapshot_interval)
+            self._snapshot_wake.clear()
+            if self._snapshot_stop.is_set():
+                break
+            if self.log.records > 0 or os.path.exists(self.log.rotated_path):
+                self.save_index()
+
+    def shutdown(self) -> None:
+        """Stop the snapshotter and fold any outstanding log records into a snapshot"""
+        self._snapshot_stop.set()
+        self._snapshot_wake.set()
+        if self._snapshot_thread is not None:
+            self._snapshot_thread.join(timeout=30)
+        if self.index is not None and not self.read_only and self.log.records > 0:
+            self.save_index()
+        self.log.close()
+
+    def persistence_stats(self) -> dict:
+        return {
+            "log_records": self.log.records,
+            "log_bytes": self.log.size_bytes(),
+            "snapshot_every_records": self.snapshot_records,
+            "snapshot_interval_s": self.snapshot_interval,
+            "last_snapshot_at": self.last_snapshot_at,
+            "embedding_store": self.store.stats(),
+        }
     
     def load_index(self):
-        """Load FAISS index and ID mapping from disk"""
+        """Load FAISS index from disk, migrating legacy .index + .mapping pairs"""
         try:
+            started = time.perf_counter()
+            mtime = os.stat(self.index_path).st_mtime_ns
             # Load FAISS index
-            self.index = faiss.read_index(self.index_path)
-            
-            # Load ID mapping
-            mapping_path = self.index_path + ".mapping"
-            if os.path.exists(mapping_path):
-                with open(mapping_path, 'rb') as f:
-                    self.image_ids = pickle.load(f)
+            index, mapped = self._read_index()
+            tombstones = np.zeros(0, dtype=bool)
+            if not isinstance(index, faiss.IndexIDMap2):
+                index = self._migrate_legacy(index, persist=not self.read_only)
             else:
-                self.image_ids = []
+                tombstones_path = self._tombstones_path(self._ids(index))
+                if os.path.exists(tombstones_path):
+                    dead_positions = np.load(tombstones_path)
+                    dead_positions = dead_positions[dead_positions < index.ntotal]
+                    tombstones = np.zeros(int(index.ntotal), dtype=bool)
+                    tombstones[dead_positions] = True
+            self._apply_search_params(self._base(index))
+            with self._lock:
+                self.index = index
+                self._tombstones = tombstones
+                self._dead = int(tombstones.sum())
+                self._trained_ntotal = int(index.ntotal)
+                self.version += 1
+            self._loaded_mtime = mtime
+            self.mapped = mapped
+            self.loads += 1
+            self.load_seconds = round(time.perf_counter() - started, 4)
+            logger.info(f"Loaded FAISS index ({self.load_mode}, mapped: {mapped}) in {self.load_seconds}s")
                 
             return True
             
         except Exception as e:
             logger.error(f"Failed to load FAISS index: {e}")
-            return False 
+            return False
+
+    def _read_index(self):
+        """(index, what was memory-mapped: "all", "inverted_lists" or None)"""
+        if not self.read_only:
+            return faiss.read_index(self.index_path), None
+        # FAISS >= 1.11 maps flat/HNSW codes in place (IO_FLAG_MMAP_IFC); older releases
+        # can only map IVF inverted lists. The two readers don't combine, so try in turn.
+        if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+            try:
+                return faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY), "all"
+            except Exception as e:
+                logger.debug(f"IO_FLAG_MMAP_IFC load of FAISS index failed: {e}")
+        try:
+            index = faiss.read_index(self.index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except Exception as e:
+            logger.debug(f"IO_FLAG_MMAP load of FAISS index failed: {e}")
+            index = faiss.read_index(self.index_path)
+        # IO_FLAG_MMAP is accepted for every index type but only maps IVF inverted lists
+        if isinstance(self._base(index), faiss.IndexIVF):
+            return index, "inverted_lists"
+        logger.warning(
+            f"FAISS {getattr(faiss, '__version__', '?')} cannot memory-map a {self._index_kind(index)} index; "
+            "it was read into memory, so workers do not share it"
+        )
+        return index, None
+
+    def _start_reloader(self) -> None:
+        if self._snapshot_thread is not None and self._snapshot_thread.is_alive():
+            return
+        self._snapshot_stop.clear()
+        self._snapshot_thread = threading.Thread(
+            target=self._reload_loop, name="faiss-reload", daemon=True
+        )
+        self._snapshot_thread.start()
+
+    def _reload_loop(self) -> None:
+        while not self._snapshot_stop.wait(timeout=self.reload_interval):
+            self.reload_if_changed()
+
+    def reload_if_changed(self) -> bool:
+        """Re-map the snapshot if a writer has published a newer one"""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._loaded_mtime:
+            return False
+        self.store.reload()
+        # The writer renames new snapshots into place, so the old mapping stays valid
+        # until we swap; in-flight searches finish against it
+        return self.load_index()
+
+    def _migrate_legacy(self, legacy_index, persist: bool = True):
+        """Wrap a position-addressed index and its pickled id list into an IndexIDMap2"""
+        import pickle  # only needed for the one-time migration
+
+        mapping_path = self.index_path + ".mapping"
+        image_ids = []
+        if os.path.exists(mapping_path):
+            with open(mapping_path, 'rb') as f:
+                image_ids = pickle.load(f)
+        else:
+            logger.error("Legacy FAISS index has no .mapping file; its vectors cannot be attributed")
+
+        n = min(int(legacy_index.ntotal), len(image_ids))
+        if n != legacy_index.ntotal or n != len(image_ids):
+            logger.warning(
+                f"Legacy FAISS index ({legacy_index.ntotal} vectors) and mapping "
+                f"({len(image_ids)} ids) disagree; keeping the first {n}"
+            )
+        vectors = self._reconstruct(legacy_index, 0, n)
+        index = self._build_index(self._target_kind(n), vectors, np.asarray(image_ids[:n], dtype='int64'))
+
+        if not persist:
+            logger.warning("Legacy FAISS index migrated in memory only; a writer must persist it")
+            return index
+
+        # Persist the new layout right away so the pickle is never read again
+        tmp_path = self.index_path + ".tmp"
+        faiss.write_index(index, tmp_path)
+        os.replace(tmp_path, self.index_path)
+        if os.path.exists(mapping_path):
+            os.remove(mapping_path)
+        logger.info(f"Migrated legacy FAISS index with {n} vectors to IndexIDMap2")
+        return index
+
+    @property
+    def active_index_type(self) -> str:
+        """Type of the index currently serving queries"""
+        return self._index_kind(self.index)
+
+    @property
+    def rebuilding(self) -> bool:
+        return self._rebuild_thread is not None and self._rebuild_thread.is_alive()
+
+    @staticmethod
+    def _base(index):
+        """The search index wrapped by an IndexIDMap2 (or the index itself)"""
+        if isinstance(index, faiss.IndexIDMap2):
+            return faiss.downcast_index(index.index)
+        return index
+
+    @staticmethod
+    def _ids(index) -> np.ndarray:
+        """Database ids in storage order of the wrapped index"""
+        return faiss.vector_to_array(index.id_map).astype('int64')
+
+    @classmethod
+    def _index_kind(cls, index) -> str:
+        if index is None:
+            return "none"
+        index = cls._base(index)
+        if isinstance(index, faiss.IndexHNSW):
+            return "hnsw"
+        if isinstance(index, faiss.IndexIVFPQ):
+            return "ivfpq"
+        if isinstance(index, faiss.IndexIVF):
+            return "ivf"
+        return "flat"
+
+    def _make_empty_index(self):
+        # IVF variants need training data, so they start flat and are rebuilt later
+        kind = "hnsw" if self.index_type == "hnsw" else "flat"
+        return self._build_index(kind, np.empty((0, self.embedding_dim), dtype='float32'), np.empty(0, dtype='int64'))
+
+    def _min_train_size(self, kind: str) -> int:
+        if kind == "ivfpq":
+            # PQ codebooks need at least 256 points per sub-quantizer centroid set
+            return max(256, 39 * max(self.ivf_nlist, 1))
+        if kind == "ivf":
+            return 39 * max(self.ivf_nlist, 1)
+        return 0
+
+    def _target_kind(self, ntotal: int) -> str:
+        """Index type the configured policy wants for an index of this size"""
+        if self.index_type == "flat":
+            return "flat"
+        if self.index_type == "auto":
+            if ntotal < self.ann_threshold:
+                return "flat"
+            kind = self.auto_index_type
+        else:
+            kind = self.index_type
+        if ntotal < self._min_train_size(kind):
+            return "flat"
+        return kind
+
+    def _nlist_for(self, n: int) -> int:
+        if self.ivf_nlist > 0:
+            return self.ivf_nlist
+        # ~4*sqrt(n) lists, but keep >= 39 training points per centroid
+        return int(max(1, min(4 * np.sqrt(n), n // 39)))
+
+    def _apply_search_params(self, index) -> None:
+        kind = self._index_kind(index)
+        if kind == "hnsw":
+            index.hnsw.efSearch = self.hnsw_ef_search
+        elif kind in ("ivf", "ivfpq"):
+            faiss.extract_index_ivf(index).nprobe = self.ivf_nprobe
+
+    def _build_index(self, kind: str, vectors: np.ndarray, ids: np.ndarray):
+        """Create an id-mapped index of the given type, train it if needed and add vectors"""
+        d = self.embedding_dim
+        if kind == "hnsw":
+            index = faiss.IndexHNSWFlat(d, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = self.hnsw_ef_construction
+        elif kind in ("ivf", "ivfpq"):
+            nlist = self._nlist_for(len(vectors))
+            quantizer = faiss.IndexFlatIP(d)
+            if kind == "ivfpq":
+                index = faiss.IndexIVFPQ(quantizer, d, nlist, self.pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_INNER_PRODUCT)
+            sample = vectors
+            if len(vectors) > self.train_sample:
+                pick = np.random.default_rng(0).choice(len(vectors), self.train_sample, replace=False)
+                sample = vectors[np.sort(pick)]
+            index.train(sample)
+        else:
+            index = faiss.IndexFlatIP(d)
+
+        self._apply_search_params(index)
+        # IndexIDMap2 keeps a reverse map so vectors can be reconstructed by id
+        id_map = faiss.IndexIDMap2(index)
+        if len(vectors):
+            id_map.add_with_ids(vectors, ids)
+        return id_map
+
+    @staticmethod
+    def _reconstruct(index, start: int, n: int) -> np.ndarray:
+        """Read vectors back out of an index by storage position (lossy for PQ)"""
+        if n <= 0:
+            return np.empty((0, index.d), dtype='float32')
+        index = FAISSManager._base(index)
+        if isinstance(index, faiss.IndexIVF):
+            index.make_direct_map()
+        return index.reconstruct_n(start, n)
+
+    @classmethod
+    def _reconstruct_at(cls, index, positions: np.ndarray) -> np.ndarray:
+        """Read vectors back out at arbitrary storage positions (lossy for PQ)"""
+        n = int(index.ntotal)
+        if len(positions) == n and n > 0:
+            return cls._reconstruct(index, 0, n)
+        vectors = np.empty((len(positions), index.d), dtype='float32')
+        base = cls._base(index)
+        if isinstance(base, faiss.IndexIVF):
+            base.make_direct_map()
+        for row, position in enumerate(positions):
+            vectors[row] = base.reconstruct(int(position))
+        return vectors
+
+    def _vectors_for(self, index, start: int, n: int) -> np.ndarray:
+        """Vectors at storage positions [start, start + n), from the store where possible"""
+        if n <= 0:
+            return np.empty((0, self.embedding_dim), dtype='float32')
+        vectors, found = self.store.get(self._ids(index)[start:start + n])
+        if not found.all():
+            missing = np.flatnonzero(~found)
+            vectors[missing] = self._reconstruct_at(index, missing + start)
+        return vectors
+
+    def _backfill_store(self) -> None:
+        """Copy vectors that predate the embedding store out of the index, once"""
+        with self._lock:
+            ids = self._ids(self.index)
+            live = ~self._dead_mask(np.arange(len(ids)))
+            _, found = self.store.get(ids)
+            missing = np.flatnonzero(live & ~found)
+            if len(missing) == 0:
+                return
+            self.store.put(ids[missing], self._reconstruct_at(self.index, missing))
+        lossy = " (PQ-reconstructed, approximate)" if self.active_index_type == "ivfpq" else ""
+        logger.info(f"Backfilled embedding store with {len(missing)} vectors from the index{lossy}")
+
+    def rebuild_from_store(self, kind: Optional[str] = None, persist: bool = True) -> bool:
+        """Build a fresh index from the embedding store alone and swap it in"""
+        try:
+            started = time.perf_counter()
+            ids, vectors = self.store.all()
+            kind = kind or self._target_kind(len(ids))
+            new_index = self._build_index(kind, vectors, ids)
+
+            with self._lock:
+                tombstones = np.zeros(int(new_index.ntotal), dtype=bool)
+                if self.index is not None:
+                    # Reconcile with changes that hit the live index while we were building
+                    current = self._ids(self.index)
+                    live_ids = current[~self._dead_mask(np.arange(len(current)))]
+                    added = np.setdiff1d(live_ids, ids)
+                    if len(added):
+                        new_index.add_with_ids(self.store.get(added)[0], added)
+                    tombstones = ~np.isin(self._ids(new_index), live_ids)
+                self.index = new_index
+                self._tombstones = tombstones
+                self._dead = int(tombstones.sum())
+                self._trained_ntotal = int(new_index.ntotal)
+                self.version += 1
+
+            logger.info(
+                f"Rebuilt FAISS index as {kind} from embedding store with {new_index.ntotal} vectors "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+            if persist:
+                self.save_index()
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to rebuild FAISS index from embedding store: {e}")
+            return False
+
+    def maybe_rebuild(self) -> bool:
+        """Start a background rebuild if the policy wants a different index type"""
+        with self._lock:
+            if self.index is None or self.read_only:
+                return False
+            if self.rebuilding:
+                return False
+
+            ntotal = int(self.index.ntotal)
+            current = self.active_index_type
+            target = self._target_kind(ntotal - self._dead)
+            # IVF centroids go stale as the library grows; retrain after 4x growth
+            retrain = target in ("ivf", "ivfpq") and current == target and ntotal >= 4 * max(self._trained_ntotal, 1)
+            # Drop tombstoned vectors once they are a noticeable share of the index
+            compact = self._dead > 0 and self._dead >= self.compact_ratio * ntotal
+            if target == current and not retrain and not compact:
+                return False
+
+            logger.info(
+                f"Rebuilding FAISS index in background: {current} -> {target} "
+                f"({ntotal} vectors, {self._dead} tombstoned)"
+            )
+            self._rebuild_thread = threading.Thread(
+                target=self.rebuild, args=(target,), name="faiss-rebuild", daemon=True
+            )
+            self._rebuild_thread.start()
+            return True
+
+    def rebuild(self, kind: str) -> bool:
+        """Rebuild the index as `kind` without tombstoned vectors and swap it in"""
+        try:
+            started = time.perf_counter()
+            with self._lock:
+                old_index = self.index
+                n0 = int(old_index.ntotal)
+                keep = ~self._dead_mask(np.arange(n0))
+                vectors = self._vectors_for(old_index, 0, n0)[keep]
+                ids = self._ids(old_index)[keep]
+
+            # Training and graph construction happen outside the lock; searches continue
+            new_index = self._build_index(kind, vectors, ids)
+
+            with self._lock:
+                if self.index is not old_index:
+                    logger.warning("FAISS index replaced during rebuild; discarding rebuilt index")
+                    return False
+                # Catch up with vectors added while we were building
+                n1 = int(old_index.ntotal)
+                if n1 > n0:
+                    new_index.add_with_ids(self._vectors_for(old_index, n0, n1 - n0), self._ids(old_index)[n0:])
+                # Deletes that landed during the build are carried over to the new positions
+                old_dead = self._dead_mask(np.arange(n1))
+                tombstones = np.concatenate([old_dead[:n0][keep], old_dead[n0:]])
+                self.index = new_index
+                self._tombstones = tombstones
+                self._dead = int(tombstones.sum())
+                self._trained_ntotal = int(new_index.ntotal)
+                self.version += 1
+
+            logger.info(
+                f"Rebuilt FAISS index as {kind} with {new_index.ntotal} vectors "
+                f"in {time.perf_counter() - started:.1f}s"
+            )
+            if kind != "flat":
+                self.evaluate_recall()
+            self.save_index()
+            return True
+
+        except Exception as e:
+            logger.error(f"Failed to rebuild FAISS index as {kind}: {e}")
+            return False
+
+    def evaluate_recall(self, k: int = 10, n_queries: int = 200) -> Optional[dict]:
+        """Measure recall@k of the live index against an exact flat search"""
+        if self.index is None or self.index.ntotal == 0:
+            return None
+        try:
+            with self._lock:
+                index = self.index
+                ntotal = int(index.ntotal)
+                live = ~self._dead_mask(np.arange(ntotal))
+                vectors = self._vectors_for(index, 0, ntotal)[live]
+                ids = self._ids(index)[live]
+            if len(ids) == 0:
+                return None
+
+            k = min(k, len(ids))
+            pick = np.random.default_rng().choice(len(ids), min(n_queries, len(ids)), replace=False)
+            queries = np.ascontiguousarray(vectors[pick])
+
+            exact = faiss.IndexFlatIP(self.embedding_dim)
+            exact.add(vectors)
+            _, truth = exact.search(queries, k)
+            found = self._search_batch(queries, k)
+
+            hits = sum(
+                len(set(ids[row]) & {image_id for image_id, _ in hits_row})
+                for row, hits_row in zip(truth, found)
+            )
+            self.last_recall = {
+                "index_type": self._index_kind(index),
+                "k": k,
+                "queries": len(queries),
+                "recall": round(hits / (k * len(queries)), 4),
+                "ntotal": len(ids),
+            }
+            logger.info(f"FAISS recall@{k}: {self.last_recall['recall']}")
+            return self.last_recall
+
+        except Exception as e:
+            logger.error(f"Failed to evaluate FAISS recall: {e}")
+            return None
@@ -0,0 +1,125 @@
+import io
+import logging
+import os
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+"""Decode image bytes once, in memory, at close to the resolution the models use"""
+
+logger = logging.getLogger(__name__)
+
+# CLIP resizes the short side to 224 and center-crops; BLIP resizes to 384x384.
+# A short side of 384 feeds both processors without upscaling anything.
+MODEL_SIDE = 384
+
+
+def decode_image(content: bytes, min_side: int = MODEL_SIDE) -> Image.Image:
+    """Encoded bytes -> RGB image whose short side is about min_side (never upscaled)
+
+    For JPEG, draft() makes libjpeg decode directly at 1/2, 1/4 or 1/8 scale,
+    which skips most of the work on large photos. Other formats (PNG, WebP,
+    HEIC) decode at full size and are reduced once here, so CLIP and BLIP
+    both start from the same small image.
+    """
+    image = Image.open(io.BytesIO(content))
+    image.draft("RGB", (min_side, min_side))
+    return shrink(image.convert("RGB"), min_side)
+
+
+def shrink(image: Image.Image, min_side: int) -> Image.Image:
+    """Resize so the short side is min_side; smaller images come back unchanged"""
+    width, height = image.size
+    scale = min_side / min(width, height)
+    if scale >= 1:
+        return image
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(size, Image.BICUBIC, reducing_gap=3.0)
+
+
+def decode_images(contents: List[bytes], min_side: int = MODEL_SIDE) -> List[Optional[Image.Image]]:
+    """decode_image for each input; None where the bytes could not be decoded"""
+    images = []
+    for content in contents:
+        try:
+            images.append(decode_image(content, min_side))
+        except Exception as e:
+            logger.warning(f"Could not decode image ({len(content) if content else 0} bytes): {e}")
+            images.append(None)
+    return images
+
+
+def perceptual_hash(image: Image.Image) -> str:
+    """64-bit difference hash (dHash) as 16 hex digits
+
+    Each bit says whether a pixel of a 9x8 grayscale thumbnail is brighter than
+    its right neighbour, so re-encodes, resizes and light edits of a photo land
+    within a few bits of each other; crops and rotations do not.
+    """
+    small = image.convert("L").resize((9, 8), Image.BOX)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            bits = (bits << 1) | (left > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+# Gallery/search derivatives: name -> longest side in pixels
+DERIVATIVE_SIZES = {
+    "thumb": int(os.getenv("THUMB_SIZE", "256")),
+    "preview": int(os.getenv("PREVIEW_SIZE", "1024")),
+}
+DERIVATIVE_FORMAT = os.getenv("DERIVATIVE_FORMAT", "webp").lower()
+if DERIVATIVE_FORMAT not in ("webp", "jpeg"):
+    logger.warning(f"Unknown DERIVATIVE_FORMAT '{DERIVATIVE_FORMAT}', using 'webp'")
+    DERIVATIVE_FORMAT = "webp"
+DERIVATIVE_QUALITY = int(os.getenv("DERIVATIVE_QUALITY", "80"))
+DERIVATIVE_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+DERIVATIVE_CONTENT_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+# EXIF orientation -> transpose that makes the pixels upright (as browsers show the original)
+_ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
+def derivative_decode_side() -> int:
+    """Short side to decode at so the largest derivative is not upscaled from a reduced decode"""
+    return max([MODEL_SIDE] + list(DERIVATIVE_SIZES.values()))
+
+
+def exif_orientation(content: bytes) -> int:
+    """EXIF orientation tag of encoded bytes (1 = upright); reads only the header"""
+    try:
+        return int(Image.open(io.BytesIO(content)).getexif().get(0x0112, 1))
+    except Exception:
+        return 1
+
+
+def make_derivatives(image: Image.Image, orientation: int = 1) -> Dict[str, bytes]:
+    """Encoded DERIVATIVE_FORMAT bytes for each DERIVATIVE_SIZES entry, upright
+
+    `image` is the already-decoded RGB image; each size is fitted within a
+    square box from it, largest first, so smaller ones resize less.
+    """
+    transpose = _ORIENTATION_TRANSPOSE.get(orientation)
+    if transpose is not None:
+        image = image.transpose(transpose)
+    fmt = "JPEG" if DERIVATIVE_FORMAT == "jpeg" else "WEBP"
+    derivatives = {}
+    for name, side in sorted(DERIVATIVE_SIZES.items(), key=lambda item: -item[1]):
+        if max(image.size) > side:
+            image = image.copy()
+            image.thumbnail((side, side), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, quality=DERIVATIVE_QUALITY)
+        derivatives[name] = buffer.getvalue()
+    return derivatives
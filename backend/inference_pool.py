@@ -0,0 +1,129 @@
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+"""Bounded worker pools that keep model inference off the event loop"""
+
+logger = logging.getLogger(__name__)
+
+
+class PoolSaturatedError(RuntimeError):
+    """Raised when a pool already has its maximum number of queued + running jobs"""
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+# torch's intra-op thread count (OpenMP/MKL/pthreadpool) is one setting for the
+# whole process, shared by every pool and the ingest worker; 0 keeps torch's default.
+# To give search and ingest different counts, run them as separate SERVING_ROLE replicas.
+TORCH_THREADS = _env_int("TORCH_THREADS", 0)
+_torch_lock = threading.Lock()
+_torch_threads_applied: Optional[int] = None
+
+
+def configure_torch_threads() -> Optional[int]:
+    """Apply TORCH_THREADS once per process; returns the thread count torch ends up with"""
+    global _torch_threads_applied
+    with _torch_lock:
+        if _torch_threads_applied is not None:
+            return _torch_threads_applied
+        try:
+            import torch
+            if TORCH_THREADS > 0:
+                torch.set_num_threads(TORCH_THREADS)
+            _torch_threads_applied = torch.get_num_threads()
+        except Exception as e:
+            logger.warning(f"Failed to set torch threads: {e}")
+        return _torch_threads_applied
+
+
+def torch_threads() -> Optional[int]:
+    return _torch_threads_applied
+
+
+class InferencePool:
+    """Thread pool with a hard cap on queued work"""
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix=f"inference-{self.name}",
+                )
+            return self._executor
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._inflight -= 1
+            if _future is not None:
+                self.completed += 1
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn in the pool; raise PoolSaturatedError instead of queueing unboundedly"""
+        executor = self._get_executor()
+        with self._lock:
+            if self._inflight >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise PoolSaturatedError(f"Inference pool '{self.name}' is saturated")
+            self._inflight += 1
+
+        try:
+            future = executor.submit(functools.partial(fn, *args, **kwargs))
+        except Exception:
+            self._release()
+            raise
+        # Release on completion of the work itself, not of the awaiting request,
+        # so cancelled requests don't free a slot that is still busy
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "inflight": self._inflight,
+                "completed": self.completed,
+                "rejected": self.rejected,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Short text queries; several workers keep latency flat under concurrent requests
+search_pool = InferencePool(
+    "search",
+    max_workers=_env_int("SEARCH_POOL_WORKERS", 2),
+    max_queue=_env_int("SEARCH_POOL_QUEUE", 32),
+)
+
+# Image embedding + captioning; heavy, so one worker
+ingest_pool = InferencePool(
+    "ingest",
+    max_workers=_env_int("INGEST_POOL_WORKERS", 1),
+    max_queue=_env_int("INGEST_POOL_QUEUE", 4),
+)
@@ -0,0 +1,561 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from uuid import uuid4
+
+import numpy as np
+
+from database import SessionLocal, Image, IngestJob
+from inference_pool import ingest_pool, PoolSaturatedError
+from db_writer import db_writer
+from ml_models import generate_image_embeddings, generate_image_captions
+from image_pipeline import (
+    DERIVATIVE_CONTENT_TYPES, DERIVATIVE_EXTENSIONS, DERIVATIVE_FORMAT, MODEL_SIDE,
+    decode_image, derivative_decode_side, exif_orientation, make_derivatives, perceptual_hash, shrink,
+)
+from dedup import dedup, content_hash
+from metadata_cache import metadata_cache, image_to_dict
+import storage
+
+"""Durable background ingestion: spooled uploads -> captions, embeddings, index"""
+
+logger = logging.getLogger(__name__)
+
+JOB_PENDING = "pending"
+JOB_PROCESSING = "processing"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.getenv(name, str(default))))
+    except ValueError:
+        return default
+
+
+def _inference_batch_size() -> int:
+    # images pushed through CLIP/BLIP per forward pass
+    return _env_int("INFERENCE_BATCH_SIZE", 8)
+
+
+def _max_attempts() -> int:
+    return _env_int("INGEST_MAX_ATTEMPTS", 3)
+
+
+def _content_type(file_ext: str) -> str:
+    return {
+        ".jpg": "image/jpeg",
+        ".jpeg": "image/jpeg",
+        ".png": "image/png",
+        ".webp": "image/webp",
+        ".heic": "image/heic",
+        ".heif": "image/heif",
+    }.get(file_ext, "application/octet-stream")
+
+
+def _spool_dir() -> str:
+    data_dir = "/app/data" if os.path.exists("/app") else "./data"
+    spool_dir = os.path.join(data_dir, "spool")
+    os.makedirs(spool_dir, exist_ok=True)
+    return spool_dir
+
+
+def _spool(filename: str, content: bytes) -> str:
+    file_ext = os.path.splitext(filename)[1].lower()
+    spool_path = os.path.join(_spool_dir(), f"{uuid4().hex}{file_ext}")
+    with open(spool_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    return spool_path
+
+
+def _insert_job(db, filename: str, spool_path: str, sha256: Optional[str] = None) -> dict:
+    job = IngestJob(filename=filename, spool_path=spool_path, status=JOB_PENDING, content_sha256=sha256)
+    db.add(job)
+    db.flush()
+    return job_to_dict(job)
+
+
+def _find_duplicate(sha256: str) -> Optional[dict]:
+    """Job-shaped result for bytes that are already stored or queued, else None"""
+    db = SessionLocal()
+    try:
+        image_id = dedup.find_stored(db, sha256)
+        if image_id is not None:
+            return {"job_id": None, "status": JOB_DONE, "image_id": image_id, "duplicate": True}
+        job = dedup.find_queued(db, sha256)
+        if job is not None:
+            return {**job_to_dict(job), "duplicate": True}
+        return None
+    finally:
+        db.close()
+
+
+async def enqueue_upload(filename: str, content: bytes) -> dict:
+    """Persist raw bytes to the spool and record a pending job for them
+
+    Bytes identical to a stored image or a queued job are not spooled again;
+    the existing image (or job) comes back with duplicate=True. Job rows go
+    through the group-commit writer, so a burst of uploads shares one
+    transaction instead of committing (and fsyncing) once per file.
+    """
+    sha256 = await asyncio.to_thread(content_hash, content)
+    if dedup.exact:
+        duplicate = await asyncio.to_thread(_find_duplicate, sha256)
+        if duplicate is not None:
+            dedup.record_exact(len(content))
+            return duplicate
+    spool_path = await asyncio.to_thread(_spool, filename, content)
+    try:
+        return await db_writer.run(_insert_job, filename, spool_path, sha256)
+    except Exception:
+        _remove_quietly(spool_path)
+        raise
+
+
+def job_to_dict(job: IngestJob) -> dict:
+    return {
+        "job_id": job.id,
+        "status": job.status,
+        "filename": job.filename,
+        "image_id": job.image_id,
+        "error": job.error,
+        "attempts": job.attempts,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+def new_stem() -> str:
+    """Key shared by an original and its derivatives (before their suffixes)"""
+    if storage.media_storage.remote:
+        return f"images/{datetime.utcnow().strftime('%Y/%m/%d')}/{uuid4().hex}"
+    return uuid4().hex
+
+
+def stem_of(stored_url: str) -> Optional[str]:
+    """The stem an existing original was stored under (for adding derivatives later)"""
+    _, key = storage.resolve(stored_url)
+    return os.path.splitext(key)[0] if key else None
+
+
+def _store_original(spool_path: str, filename: str, content: Optional[bytes] = None, stem: Optional[str] = None) -> str:
+    """Copy spooled bytes to their final home (S3 or local uploads); return public URL
+
+    `content` is the spooled bytes when the caller already has them in memory.
+    The spool file is left in place until the job's row is committed, so a
+    retried job can still read it.
+    """
+    file_ext = os.path.splitext(filename)[1].lower()
+    key = (stem or new_stem()) + file_ext
+    media = storage.media_storage
+    if content is not None:
+        return media.put_bytes(key, content, _content_type(file_ext))
+    return media.put_file(key, spool_path, _content_type(file_ext))
+
+
+def store_derivatives(stem: str, derivatives: Dict[str, bytes]) -> Dict[str, str]:
+    """Store encoded derivatives next to the original as <stem>_<name><ext>; name -> URL"""
+    ext = DERIVATIVE_EXTENSIONS[DERIVATIVE_FORMAT]
+    content_type = DERIVATIVE_CONTENT_TYPES[DERIVATIVE_FORMAT]
+    return {
+        name: storage.media_storage.put_bytes(f"{stem}_{name}{ext}", data, content_type)
+        for name, data in derivatives.items()
+    }
+
+
+def store_image_derivatives(stem: str, image, orientation: int) -> Dict[str, str]:
+    """Best effort: a missing derivative only means clients fall back to the original"""
+    try:
+        return store_derivatives(stem, make_derivatives(image, orientation))
+    except Exception as e:
+        logger.warning(f"Could not store derivatives for {stem}: {e}")
+        return {}
+
+
+def read_original(stored_url: str) -> Optional[bytes]:
+    """Fetch the original bytes behind an Image.s3_url"""
+    store, key = storage.resolve(stored_url)
+    return store.get_bytes(key) if store else None
+
+
+def delete_original(stored_url: str) -> bool:
+    """Remove the file behind an Image.s3_url (or a derivative URL) from local storage or S3"""
+    store, key = storage.resolve(stored_url)
+    return store.delete(key) if store else False
+
+
+async def astore_image(content: bytes, filename: str, derivatives: Dict[str, bytes]) -> Tuple[str, Dict[str, str]]:
+    """Upload an original and its encoded derivatives concurrently; (url, name -> url)
+
+    Derivatives are best effort, as in ingestion; a failed original raises
+    after removing whatever derivatives were already stored.
+    """
+    media = storage.media_storage
+    stem = new_stem()
+    file_ext = os.path.splitext(filename)[1].lower()
+    ext = DERIVATIVE_EXTENSIONS[DERIVATIVE_FORMAT]
+    names = list(derivatives)
+    results = await asyncio.gather(
+        media.aput_bytes(stem + file_ext, content, _content_type(file_ext)),
+        *(media.aput_bytes(f"{stem}_{name}{ext}", derivatives[name], DERIVATIVE_CONTENT_TYPES[DERIVATIVE_FORMAT]) for name in names),
+        return_exceptions=True,
+    )
+    if isinstance(results[0], BaseException):
+        stored = [f"{stem}_{name}{ext}" for name, result in zip(names, results[1:]) if not isinstance(result, BaseException)]
+        await asyncio.gather(*(media.adelete(key) for key in stored), return_exceptions=True)
+        raise results[0]
+    urls = {}
+    for name, result in zip(names, results[1:]):
+        if isinstance(result, BaseException):
+            logger.warning(f"Could not store {name} derivative for {stem}: {result}")
+        else:
+            urls[name] = result
+    return results[0], urls
+
+
+async def aread_original(stored_url: str) -> Optional[bytes]:
+    """read_original on the storage backend's I/O threads"""
+    store, key = storage.resolve(stored_url)
+    return await store.aget_bytes(key) if store else None
+
+
+async def adelete_original(stored_url: str) -> bool:
+    """delete_original on the storage backend's I/O threads"""
+    store, key = storage.resolve(stored_url)
+    return await store.adelete(key) if store else False
+
+
+def _remove_quietly(path: Optional[str]) -> None:
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception:
+            pass
+
+
+class IngestWorker:
+    """Single background task that drains pending jobs in inference-sized batches"""
+
+    def __init__(self, poll_interval: float = 2.0):
+        self.poll_interval = poll_interval
+        self.faiss_manager = None
+        self._task: Optional[asyncio.Task] = None
+        self._wake: Optional[asyncio.Event] = None
+
+    def start(self, faiss_manager) -> None:
+        self.faiss_manager = faiss_manager
+        requeued = self._recover()
+        if requeued:
+            logger.info(f"Re-queued {requeued} interrupted ingestion jobs")
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self) -> None:
+        """Wake the worker right away instead of waiting for the next poll"""
+        if self._wake is not None:
+            self._wake.set()
+
+    def _recover(self) -> int:
+        # Jobs left "processing" by a crash or restart go back to the queue
+        db = SessionLocal()
+        try:
+            count = (
+                db.query(IngestJob)
+                .filter(IngestJob.status == JOB_PROCESSING)
+                .update({IngestJob.status: JOB_PENDING}, synchronize_session=False)
+            )
+            db.commit()
+            return count
+        finally:
+            db.close()
+
+    def _claim(self, limit: int) -> List[int]:
+        db = SessionLocal()
+        try:
+            jobs = (
+                db.query(IngestJob)
+                .filter(IngestJob.status == JOB_PENDING)
+                .order_by(IngestJob.id)
+                .limit(limit)
+                .all()
+            )
+            for job in jobs:
+                job.status = JOB_PROCESSING
+                job.attempts = (job.attempts or 0) + 1
+            db.commit()
+            return [job.id for job in jobs]
+        finally:
+            db.close()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                job_ids = await asyncio.to_thread(self._claim, _inference_batch_size())
+                if not job_ids:
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), timeout=self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                try:
+                    await ingest_pool.run(self._process_batch, job_ids)
+                except PoolSaturatedError:
+                    # Shouldn't happen with a single consumer; back off and retry
+                    await asyncio.to_thread(self._release, job_ids)
+                    await asyncio.sleep(self.poll_interval)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ingestion worker iteration failed: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    def _release(self, job_ids: List[int]) -> None:
+        db = SessionLocal()
+        try:
+            for job in db.query(IngestJob).filter(IngestJob.id.in_(job_ids)).all():
+                job.status = JOB_PENDING
+                job.attempts = max(0, (job.attempts or 0) - 1)
+            db.commit()
+        finally:
+            db.close()
+
+    def _fail(self, db, job: IngestJob, error: str) -> None:
+        job.error = error
+        if (job.attempts or 0) >= _max_attempts():
+            job.status = JOB_FAILED
+            _remove_quietly(job.spool_path)
+        else:
+            job.status = JOB_PENDING
+
+    def _reuse_near_duplicates(self, db, decoded: list, hashes: dict) -> dict:
+        """job id -> (embedding, caption) copied from the nearest stored image by perceptual hash"""
+        matches = {}
+        for job, _ in decoded:
+            image_id = dedup.find_near(hashes[job.id][1])
+            if image_id is not None:
+                matches[job.id] = image_id
+        if not matches:
+            return {}
+
+        ids = sorted(set(matches.values()))
+        vectors, found = self.faiss_manager.get_embeddings(ids)
+        stored = {image_id: vectors[i] for i, image_id in enumerate(ids) if found[i]}
+        metadata = metadata_cache.get_many(db, ids)
+        reused = {}
+        for job_id, image_id in matches.items():
+            caption = metadata.get(image_id, {}).get("caption")
+            if image_id not in stored or not caption or caption == "Caption generation failed":
+                continue
+            reused[job_id] = (stored[image_id], caption)
+            dedup.record_near()
+        return reused
+
+    def _resume_indexing(self, db, resumed: list) -> Tuple[List[IngestJob], List[int], list]:
+        """(jobs, image ids, embeddings) to index for jobs whose row is already committed"""
+        if not resumed:
+            return [], [], []
+        existing = {
+            row.id for row in db.query(Image.id).filter(Image.id.in_([job.image_id for job, _ in resumed])).all()
+        }
+        live = []
+        for job, image in resumed:
+            if job.image_id in existing:
+                live.append((job, image))
+            else:
+                # Deleted before its vector was indexed; nothing left to do
+                job.status = JOB_DONE
+                _remove_quietly(job.spool_path)
+        if not live:
+            return [], [], []
+        embeddings = generate_image_embeddings([image for _, image in live])
+        if embeddings is None:
+            for job, _ in live:
+                self._fail(db, job, "CLIP failed to process image")
+            return [], [], []
+        ids = [job.image_id for job, _ in live]
+        # The earlier add may have landed before the crash; drop it so the add below upserts
+        self.faiss_manager.remove_embeddings(ids)
+        logger.info(f"Indexing {len(ids)} images whose rows were committed by an interrupted batch")
+        return [job for job, _ in live], ids, list(embeddings)
+
+    def _process_batch(self, job_ids: List[int]) -> None:
+        """Decode, embed and caption one batch; one DB commit and one FAISS add for it"""
+        db = SessionLocal()
+        stored_urls = []
+        try:
+            jobs = db.query(IngestJob).filter(IngestJob.id.in_(job_ids)).order_by(IngestJob.id).all()
+
+            decoded = []
+            contents = {}
+            full = {}
+            for job in jobs:
+                try:
+                    with open(job.spool_path, "rb") as f:
+                        contents[job.id] = f.read()
+                    # One reduced-resolution decode feeds the derivatives, CLIP and BLIP
+                    full[job.id] = decode_image(contents[job.id], derivative_decode_side())
+                    decoded.append((job, shrink(full[job.id], MODEL_SIDE)))
+                except Exception as e:
+                    logger.error(f"Failed to decode {job.filename} (job {job.id}): {e}")
+                    job.attempts = _max_attempts()
+                    self._fail(db, job, "Image could not be decoded")
+
+            # A job whose row was committed but whose vector never reached the index (a crash
+            # or failed add after the commit) only needs the vector: re-embed, no new row
+            resumed = [(job, image) for job, image in decoded if job.image_id is not None]
+            decoded = [(job, image) for job, image in decoded if job.image_id is None]
+            if not decoded and not resumed:
+                db.commit()
+                return
+            index_jobs, index_ids, index_vectors = self._resume_indexing(db, resumed)
+
+            # Byte-identical copies of a stored image (or of an earlier job in this batch) skip inference
+            hashes = {}
+            copies = []
+            first_in_batch = {}
+            unique = []
+            for job, image in decoded:
+                sha256 = job.content_sha256 or content_hash(contents[job.id])
+                stored_id = dedup.find_stored(db, sha256)
+                if stored_id is not None:
+                    copies.append((job, stored_id, None))
+                elif dedup.exact and sha256 in first_in_batch:
+                    copies.append((job, None, first_in_batch[sha256]))
+                else:
+                    first_in_batch[sha256] = job
+                    hashes[job.id] = (sha256, perceptual_hash(image))
+                    unique.append((job, image))
+
+            # Near duplicates reuse the stored vector and caption of the closest image
+            results = self._reuse_near_duplicates(db, unique, hashes)
+            fresh = [(job, image) for job, image in unique if job.id not in results]
+            if fresh:
+                images = [image for _, image in fresh]
+                embeddings = generate_image_embeddings(images)
+                captions = generate_image_captions(images) if embeddings is not None else None
+                if embeddings is None:
+                    for job, _ in fresh:
+                        self._fail(db, job, "CLIP failed to process image")
+                else:
+                    if captions is None:
+                        captions = ["Caption generation failed"] * len(fresh)
+                    for (job, _), embedding, caption in zip(fresh, embeddings, captions):
+                        results[job.id] = (embedding, caption)
+
+            # Originals and derivatives of the whole batch go out concurrently on the storage pool
+            media = storage.media_storage
+            uploads = {}
+            for job, _ in unique:
+                if job.id in results:
+                    stem = new_stem()
+                    uploads[job.id] = (
+                        media.submit(_store_original, job.spool_path, job.filename, contents.get(job.id), stem),
+                        media.submit(store_image_derivatives, stem, full[job.id], exif_orientation(contents[job.id])),
+                    )
+
+            rows = []
+            row_embeddings = []
+            for job, _ in unique:
+                if job.id not in uploads:
+                    continue
+                embedding, caption = results[job.id]
+                original_upload, derivatives_upload = uploads[job.id]
+                try:
+                    stored_path = original_upload.result()
+                except Exception as e:
+                    logger.error(f"Failed to store original for job {job.id}: {e}")
+                    self._fail(db, job, "Storing original failed")
+                    continue
+                derivatives = derivatives_upload.result()
+                stored_urls.extend([stored_path, *derivatives.values()])
+                sha256, phash = hashes[job.id]
+                row = Image(
+                    filename=job.filename,
+                    s3_url=stored_path,
+                    thumb_url=derivatives.get("thumb"),
+                    preview_url=derivatives.get("preview"),
+                    caption=caption,
+                    uploaded_at=datetime.utcnow(),
+                    content_sha256=sha256,
+                    phash=phash,
+                )
+                rows.append((job, row))
+                row_embeddings.append(embedding)
+
+            db.add_all([row for _, row in rows])
+            # flush to get primary keys without re-reading each row after commit
+            db.flush()
+            for job, row in rows:
+                # Stays "processing" until its vector is indexed below
+                job.image_id = row.id
+                job.error = None
+            finished = []
+            for job, stored_id, original in copies:
+                image_id = stored_id if original is None else original.image_id
+                if image_id is None:
+                    # The upload it copies failed this round; retry alongside it
+                    self._fail(db, job, "Duplicate of an upload that failed")
+                    continue
+                job.image_id = image_id
+                job.status = JOB_DONE
+                job.error = None
+                finished.append(job)
+                dedup.record_exact(len(contents[job.id]))
+            # Snapshot before commit expires the rows
+            cached = [image_to_dict(row) for _, row in rows]
+            hashed = [(row.id, row.phash) for _, row in rows]
+            index_jobs += [job for job, _ in rows]
+            index_ids += [row.id for _, row in rows]
+            index_vectors += row_embeddings
+
+            # Rows commit before their vectors are indexed, so the log never holds a vector
+            # for a row that doesn't exist; their jobs keep image_id and stay "processing",
+            # and a crash or failed add from here on is retried as an index-only job
+            db.commit()
+            stored_urls = []
+            metadata_cache.put(cached)
+            dedup.add(hashed)
+
+            if index_ids and not self.faiss_manager.add_embeddings(np.stack(index_vectors), index_ids):
+                raise RuntimeError(f"Failed to index {len(index_ids)} ingested images")
+            for job in index_jobs:
+                job.status = JOB_DONE
+            db.commit()
+
+            for job in finished + index_jobs:
+                _remove_quietly(job.spool_path)
+
+            logger.info(f"Ingested {len(rows)} of {len(jobs)} images in batch ({len(copies)} exact duplicates)")
+
+        except Exception as e:
+            logger.error(f"Ingestion batch {job_ids} failed: {e}")
+            db.rollback()
+            # Objects stored for rows that were never committed would be orphaned
+            for url in stored_urls:
+                delete_original(url)
+            for job in db.query(IngestJob).filter(IngestJob.id.in_(job_ids)).all():
+                if job.status == JOB_PROCESSING:
+                    self._fail(db, job, "Ingestion processing failed")
+            db.commit()
+        finally:
+            db.close()
+
+
+worker = IngestWorker()
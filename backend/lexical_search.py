@@ -0,0 +1,52 @@
+import logging
+import re
+from typing import Dict, List, Sequence, Tuple
+
+from sqlalchemy import text
+
+import database
+
+"""Caption/filename keyword search over images_fts and rank fusion with vector hits"""
+
+logger = logging.getLogger(__name__)
+
+# Constant from the original RRF paper; damps the weight of the very top ranks
+RRF_K = 60
+
+# Filename matches count for less than caption matches
+_SEARCH_SQL = text(
+    "SELECT rowid AS id, bm25(images_fts, 1.0, 0.5) AS rank "
+    "FROM images_fts WHERE images_fts MATCH :match "
+    "ORDER BY rank LIMIT :limit"
+)
+
+
+def match_expression(query: str) -> str:
+    """FTS5 MATCH string for free text: every word quoted, any word may match"""
+    terms = re.findall(r"\w+", query.lower())
+    return " OR ".join(f'"{term}"' for term in dict.fromkeys(terms))
+
+
+def search_captions(db, query: str, limit: int) -> List[Tuple[int, float]]:
+    """Best lexical matches as (image_id, score), higher is better"""
+    if not database.fts_enabled or limit <= 0:
+        return []
+    match = match_expression(query)
+    if not match:
+        return []
+    try:
+        rows = db.execute(_SEARCH_SQL, {"match": match, "limit": limit}).all()
+    except Exception as e:
+        logger.error(f"Caption search failed for '{query}': {e}")
+        return []
+    # bm25() is lower-is-better; flip it so scores sort like similarities
+    return [(int(row.id), -float(row.rank)) for row in rows]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Tuple[int, float]]], k: int = RRF_K) -> List[Tuple[int, float]]:
+    """Merge ranked (id, score) lists by summing 1 / (k + rank) for each id"""
+    fused: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, (image_id, _) in enumerate(ranking, start=1):
+            fused[image_id] = fused.get(image_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
@@ -1,18 +1,50 @@
+import asyncio
 import os
 import logging
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Query
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from database import init_db
+import database
+from database import init_db, is_sqlite, SQLITE_PROFILE
 from routers import search, auth, upload
 from routers import images as images_router
-from ml_models import load_models, clip_model, blip_model
+import ml_models
 from faiss_manager import FAISSManager
+from inference_pool import search_pool, ingest_pool, configure_torch_threads, torch_threads
+from ingest_worker import worker as ingest_worker
+from text_batcher import text_batcher
+from search_cache import embedding_cache, result_cache
+from metadata_cache import metadata_cache
+from dedup import dedup
+from db_writer import db_writer
+import storage
 from dotenv import load_dotenv
 
 # Load env for local dev
 load_dotenv()
 
+_process_started = time.perf_counter()
+startup_seconds = None
+
+
+def _rss_mb():
+    """Resident set size of this worker; page-cache-backed mmaps are shared across workers"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+        # ru_maxrss is the peak, in KiB on Linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    except Exception:
+        return None
+
 # Create the FastAPI application instance
 app = FastAPI(
     title="Pique API",
@@ -42,17 +74,24 @@ if not faiss_index_path:
     data_dir = "/app/data" if os.path.exists("/app") else "./data"
     os.makedirs(data_dir, exist_ok=True)
     faiss_index_path = os.path.join(data_dir, "faiss_index.index")
-faiss_manager = FAISSManager(index_path=faiss_index_path, s3_key=os.getenv("S3_FAISS_KEY"))
+# Search replicas never write the index: by default they map the snapshot read-only and
+# follow the ones ingest nodes publish (see FAISS_LOAD_MODE)
+serving_role = ml_models.serving_role
+faiss_manager = FAISSManager(
+    index_path=faiss_index_path,
+    s3_key=os.getenv("S3_FAISS_KEY"),
+    load_mode=os.getenv("FAISS_LOAD_MODE") or ("mmap" if serving_role == "search" else None),
+)
 
 # Serve local uploads for development/testing
-uploads_dir = "/app/uploads" if os.path.exists("/app") else "./uploads"
-os.makedirs(uploads_dir, exist_ok=True)
-app.mount("/uploads", StaticFiles(directory=uploads_dir), name="uploads")
+app.mount("/uploads", StaticFiles(directory=storage.local_storage.root), name="uploads")
 
-# Include routers
+# Include routers (SERVING_ROLE=search drops uploads, SERVING_ROLE=ingest drops /search)
 app.include_router(auth.router, prefix="/auth", tags=["authentication"])
-app.include_router(search.router, prefix="/search", tags=["search"])
-app.include_router(upload.router, prefix="/upload", tags=["upload"])
+if serving_role != "ingest":
+    app.include_router(search.router, prefix="/search", tags=["search"])
+if serving_role != "search":
+    app.include_router(upload.router, prefix="/upload", tags=["upload"])
 app.include_router(images_router.router, prefix="/images", tags=["images"]) 
 
 
@@ -62,17 +101,49 @@ async def startup_event():
     # Initialize database
     await init_db()
     
-    # Load ML models
-    models_loaded = load_models()
-    if not models_loaded:
-        print("WARNING: ML models failed to load!")
+    # Warm the metadata used to hydrate search hits
+    try:
+        await asyncio.to_thread(metadata_cache.load)
+    except Exception as e:
+        print(f"WARNING: Failed to warm image metadata cache: {e}")
+    
+    # Load ML models in the background so the app answers liveness probes right away:
+    # the CLIP text tower first (search becomes ready), then full CLIP for ingest
+    # roles, then BLIP unless deferred to the first upload
+    blip_mode = os.getenv("BLIP_LOAD", "background").lower()
+    # One process-wide torch thread count, set before any model runs
+    configure_torch_threads()
+    app.state.model_loader = asyncio.create_task(asyncio.to_thread(ml_models.load_staged, blip_mode))
     
     # Initialize FAISS index
     faiss_initialized = faiss_manager.initialize_index()
     if not faiss_initialized:
         print("WARNING: FAISS index failed to initialize!")
     
-    print("Pique API started successfully!")
+    # Resume any queued uploads and start the ingestion worker
+    if serving_role != "search":
+        try:
+            await asyncio.to_thread(dedup.load)
+        except Exception as e:
+            print(f"WARNING: Failed to load perceptual hashes: {e}")
+        ingest_worker.start(faiss_manager)
+    
+    global startup_seconds
+    startup_seconds = round(time.perf_counter() - _process_started, 3)
+    print(f"Pique API ({serving_role}) started successfully in {startup_seconds}s!")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the ingestion worker and inference pools"""
+    await ingest_worker.stop()
+    await text_batcher.stop()
+    await asyncio.to_thread(db_writer.stop)
+    # Fold the embedding log into a final snapshot so the next start replays nothing
+    await asyncio.to_thread(faiss_manager.shutdown)
+    search_pool.shutdown()
+    ingest_pool.shutdown()
+    storage.shutdown()
 
 
 @app.get("/")
@@ -81,24 +152,90 @@ async def root():
     return {"message": "Pique API is running", "status": "healthy"}
 
 
+def _readiness() -> dict:
+    capabilities = ml_models.capabilities()
+    index_ready = faiss_manager.index is not None
+    return {
+        # Vector/hybrid search needs the text encoder and the index
+        "search": capabilities["search"] and index_ready,
+        "lexical_search": database.fts_enabled,
+        "captioning": capabilities["captioning"],
+        "ingest": capabilities["ingest"] and index_ready,
+        "models": capabilities["models"],
+        "model_load_seconds": capabilities["load_seconds"],
+    }
+
+
+@app.get("/health/live")
+async def liveness():
+    """The process is up and serving requests (models may still be loading)"""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready")
+async def readiness(
+    capability: str = Query("search", pattern="^(search|lexical_search|captioning|ingest)$"),
+):
+    """200 once `capability` can be served, 503 before; the body lists every capability"""
+    ready = _readiness()
+    body = {"ready": ready[capability], "capability": capability, "capabilities": ready}
+    return JSONResponse(status_code=200 if ready[capability] else 503, content=body)
+
+
 @app.get("/health")
 async def health_check():
     """More detailed health check endpoint"""
     # naive status flags
     db_status = "connected"  # tables are created on startup; deeper checks optional
+    db_settings = {"profile": SQLITE_PROFILE if is_sqlite else None, "group_commit": db_writer.stats()}
     models_status = {
-        "clip": clip_model is not None,
-        "blip": blip_model is not None,
+        "clip": ml_models.clip_model is not None,
+        "blip": ml_models.blip_model is not None,
     }
     faiss_status = {
         "initialized": faiss_manager.index is not None,
         "ntotal": int(faiss_manager.index.ntotal) if faiss_manager.index is not None else 0,
+        "version": faiss_manager.version,
+        "index_type": faiss_manager.active_index_type,
+        "configured_type": faiss_manager.index_type,
+        "rebuilding": faiss_manager.rebuilding,
+        "tombstones": faiss_manager.tombstones,
+        "persistence": faiss_manager.persistence_stats(),
+        "last_recall": faiss_manager.last_recall,
         "path": faiss_manager.index_path,
+        "load_mode": faiss_manager.load_mode,
+        "read_only": faiss_manager.read_only,
+        "mapped": faiss_manager.mapped,
+        "load_seconds": faiss_manager.load_seconds,
     }
     return {
         "status": "healthy",
+        "serving_role": serving_role,
         "database": db_status,
+        "database_settings": db_settings,
         "models": models_status,
+        "capabilities": _readiness(),
         "faiss": faiss_status,
+        "process": {
+            "pid": os.getpid(),
+            "rss_mb": _rss_mb(),
+            "startup_seconds": startup_seconds,
+        },
+        "inference_pools": {
+            "search": search_pool.stats(),
+            "ingest": ingest_pool.stats(),
+            "torch_threads": torch_threads(),
+        },
+        "text_batching": text_batcher.stats(),
+        "dedup": dedup.stats(),
+        "storage": {
+            "media": storage.media_storage.stats(),
+            "index_backup": storage.s3_storage.stats() if storage.s3_storage is not None else None,
+        },
+        "search_cache": {
+            "query_embeddings": embedding_cache.stats(),
+            "results": result_cache.stats(),
+            "image_metadata": metadata_cache.stats(),
+        },
         "version": "1.0.0",
     }
@@ -0,0 +1,153 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from database import SessionLocal, Image
+
+"""In-process cache of the Image columns search results are hydrated with"""
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+# Only the columns a search hit needs; never the whole ORM row
+_COLUMNS = (
+    Image.id, Image.filename, Image.caption, Image.s3_url, Image.thumb_url, Image.preview_url, Image.uploaded_at,
+)
+
+
+def image_to_dict(row) -> dict:
+    return {
+        "id": row.id,
+        "filename": row.filename,
+        "caption": row.caption,
+        "s3_url": row.s3_url,
+        "thumb_url": row.thumb_url,
+        "preview_url": row.preview_url,
+        "uploaded_at": row.uploaded_at.isoformat() if row.uploaded_at else None,
+    }
+
+
+class MetadataCache:
+    """id -> image metadata, warmed at startup and kept current by writers in this process
+
+    Lookups that miss (e.g. rows written by another process, or beyond
+    max_entries) are fetched in one IN (...) query and cached. Writes made by
+    other replicas or scripts are not seen here, so entries expire after
+    ttl_seconds, and everything is dropped when the caller's index generation
+    changes (a replica re-mapping a newer snapshot).
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float = 300):
+        self.max_entries = max(0, max_entries)
+        self.ttl_seconds = ttl_seconds
+        # id -> (monotonic time cached, metadata)
+        self._rows: Dict[int, Tuple[float, dict]] = {}
+        self._generation: Optional[int] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def load(self) -> int:
+        """Warm the cache with the newest max_entries images"""
+        if self.max_entries == 0:
+            return 0
+        db = SessionLocal()
+        try:
+            rows = (
+                db.query(*_COLUMNS)
+                .order_by(Image.id.desc())
+                .limit(self.max_entries)
+                .all()
+            )
+        finally:
+            db.close()
+        now = time.monotonic()
+        with self._lock:
+            self._rows = {row.id: (now, image_to_dict(row)) for row in rows}
+        logger.info(f"Warmed image metadata cache with {len(rows)} rows")
+        return len(rows)
+
+    def _store(self, entries: Iterable[dict]) -> None:
+        now = time.monotonic()
+        for entry in entries:
+            if entry["id"] in self._rows or len(self._rows) < self.max_entries:
+                self._rows[entry["id"]] = (now, entry)
+
+    def put(self, entries: Iterable[dict]) -> None:
+        """Record inserted or updated images (as built by image_to_dict)"""
+        with self._lock:
+            self._store(entries)
+
+    def remove(self, image_ids: Iterable[int]) -> None:
+        with self._lock:
+            for image_id in image_ids:
+                self._rows.pop(image_id, None)
+
+    def get_many(self, db, image_ids: List[int], generation: Optional[int] = None) -> Dict[int, dict]:
+        """Metadata for these ids; misses and expired entries are fetched from the DB in a single query
+
+        `generation` identifies the loaded index (FAISSManager.loads); when it
+        changes the whole cache is dropped.
+        """
+        found: Dict[int, dict] = {}
+        oldest = time.monotonic() - self.ttl_seconds
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                if self._generation is not None:
+                    self._rows.clear()
+                self._generation = generation
+            for image_id in image_ids:
+                cached = self._rows.get(image_id)
+                if cached is None:
+                    continue
+                if cached[0] < oldest:
+                    self.expired += 1
+                    continue
+                found[image_id] = cached[1]
+            missing = [image_id for image_id in image_ids if image_id not in found]
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            fetched = [image_to_dict(row) for row in db.query(*_COLUMNS).filter(Image.id.in_(missing)).all()]
+            with self._lock:
+                self._store(fetched)
+                # Expired entries whose row is gone must not be served again
+                for image_id in set(missing) - {entry["id"] for entry in fetched}:
+                    self._rows.pop(image_id, None)
+            for entry in fetched:
+                found[entry["id"]] = entry
+        return found
+
+    def clear(self) -> None:
+        with self._lock:
+            self._rows.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._rows),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "ttl_seconds": self.ttl_seconds,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+metadata_cache = MetadataCache(
+    max_entries=_env_int("METADATA_CACHE_SIZE", 200000),
+    ttl_seconds=_env_int("METADATA_CACHE_TTL_S", 300),
+)
@@ -1,116 +1,334 @@
 import torch
 from transformers import BlipProcessor, BlipForConditionalGeneration
+from transformers import CLIPTextModelWithProjection, CLIPTokenizerFast
 from sentence_transformers import SentenceTransformer
 from PIL import Image
 from pillow_heif import register_heif_opener
 import logging
-from typing import Optional, List
+import os
+import threading
+import time
+from typing import Optional, List, Tuple
 import numpy as np
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+# torch: fp32 PyTorch; torch-int8: dynamically quantized Linear layers;
+# onnx: ONNX Runtime for CLIP (BLIP's autoregressive generate stays on torch-int8)
+INFERENCE_BACKENDS = ("torch", "torch-int8", "onnx")
+inference_backend = os.getenv("INFERENCE_BACKEND", "torch").lower()
+if inference_backend not in INFERENCE_BACKENDS:
+    logger.warning(f"Unknown INFERENCE_BACKEND '{inference_backend}', using 'torch'")
+    inference_backend = "torch"
+
+# search: CLIP text tower only (queries), no BLIP, no ingestion; ingest: full models,
+# no /search; all: everything in one process
+SERVING_ROLES = ("search", "ingest", "all")
+serving_role = os.getenv("SERVING_ROLE", "all").lower()
+if serving_role not in SERVING_ROLES:
+    logger.warning(f"Unknown SERVING_ROLE '{serving_role}', using 'all'")
+    serving_role = "all"
+
+# The Hugging Face checkpoint behind SentenceTransformer('clip-ViT-B-32'); its text
+# tower alone produces the same query vectors as the full model
+CLIP_TEXT_CHECKPOINT = "openai/clip-vit-base-patch32"
+
 # Global model instances
 clip_model = None
+clip_encoder = None  # what the generate_* functions call; wraps clip_model for the backend
+# SERVING_ROLE=all: the CLIP text tower answers queries until the full model is loaded
+text_encoder = None
 blip_processor = None
 blip_model = None
+active_backends = {}  # model -> backend actually in use (after any fallback)
 
+# Loading happens in stages (CLIP for search first, BLIP for captions later), so
+# each model tracks its own state: pending -> loading -> ready | failed
+model_status = {"clip_text": "pending", "clip": "pending", "blip": "pending"}
+model_load_seconds = {}
+_load_locks = {"clip_text": threading.Lock(), "clip": threading.Lock(), "blip": threading.Lock()}
 
-def load_models():
-    """Initialize CLIP and BLIP models"""
-    global clip_model, blip_processor, blip_model
-    
+
+def _register_heif():
+    # Enable HEIC/HEIF support in PIL when available
     try:
-        # Enable HEIC/HEIF support in PIL when available
+        register_heif_opener()
+    except Exception:
+        # Non-fatal if HEIF opener not available
+        pass
+
+
+class TorchClipEncoder:
+    """CLIP through SentenceTransformer.encode (fp32 or dynamically quantized)"""
+
+    def __init__(self, model):
+        self.model = model
+
+    def _encode(self, inputs) -> np.ndarray:
+        with torch.inference_mode():
+            embeddings = self.model.encode(
+                inputs,
+                batch_size=len(inputs),
+                convert_to_numpy=True,
+                normalize_embeddings=False,
+            )
+        return embeddings if isinstance(embeddings, np.ndarray) else np.array(embeddings)
+
+    def encode_text(self, texts: List[str]) -> np.ndarray:
+        return self._encode(texts)
+
+    def encode_images(self, images: List[Image.Image]) -> np.ndarray:
+        return self._encode(images)
+
+
+class TextOnlyClipEncoder:
+    """Just the CLIP text tower and tokenizer, for search replicas"""
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+
+    def encode_text(self, texts: List[str]) -> np.ndarray:
+        tokens = self.tokenizer(texts, padding=True, truncation=True, max_length=77, return_tensors="pt")
+        with torch.inference_mode():
+            return self.model(**tokens).text_embeds.numpy()
+
+    def encode_images(self, images: List[Image.Image]) -> np.ndarray:
+        raise RuntimeError("Image embeddings need the full CLIP model (SERVING_ROLE=search loads only the text tower)")
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of every Linear layer (weights int8, activations per batch)"""
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def build_clip_encoder(model, backend: str) -> Tuple[object, str]:
+    """Wrap a loaded SentenceTransformer CLIP for `backend`; returns (encoder, backend used)"""
+    if backend == "onnx":
         try:
-            register_heif_opener()
-        except Exception:
-            # Non-fatal if HEIF opener not available
-            pass
-
-        # Load CLIP model for embeddings
-        logger.info("Loading CLIP model...")
-        clip_model = SentenceTransformer('clip-ViT-B-32')
-        
-        # Load BLIP model for captions
-        logger.info("Loading BLIP model...")
-        blip_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-        blip_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-        
-        logger.info("All ML models loaded successfully!")
+            from onnx_backend import OnnxClip
+            threads = int(os.getenv("ONNX_THREADS", "0"))
+            int8 = os.getenv("ONNX_INT8", "false").lower() in ("1", "true", "yes")
+            return OnnxClip(model, threads=threads, int8=int8), "onnx"
+        except Exception as e:
+            logger.warning(f"ONNX Runtime CLIP unavailable ({e}); using PyTorch fp32")
+            return TorchClipEncoder(model), "torch"
+    if backend == "torch-int8":
+        return TorchClipEncoder(quantize_int8(model)), "torch-int8"
+    return TorchClipEncoder(model), "torch"
+
+
+def build_clip_text_encoder(backend: str) -> Tuple[object, str]:
+    """Load the CLIP text tower alone; returns (encoder, backend used)"""
+    tokenizer = CLIPTokenizerFast.from_pretrained(CLIP_TEXT_CHECKPOINT)
+    model = CLIPTextModelWithProjection.from_pretrained(CLIP_TEXT_CHECKPOINT).eval()
+    # The ONNX export covers the full model; the text tower alone runs int8 instead
+    if backend in ("torch-int8", "onnx"):
+        return TextOnlyClipEncoder(quantize_int8(model), tokenizer), "torch-int8"
+    return TextOnlyClipEncoder(model, tokenizer), "torch"
+
+
+def build_blip(model, backend: str) -> Tuple[object, str]:
+    if backend in ("torch-int8", "onnx"):
+        return quantize_int8(model), "torch-int8"
+    return model, "torch"
+
+
+def load_clip_text() -> bool:
+    """Load the CLIP text tower to serve queries before the full model; idempotent and thread-safe"""
+    global text_encoder
+    with _load_locks["clip_text"]:
+        if text_encoder is not None or clip_model is not None:
+            return True
+        model_status["clip_text"] = "loading"
+        started = time.perf_counter()
+        try:
+            logger.info(f"Loading CLIP text encoder ({inference_backend})...")
+            encoder, active_backends["clip_text"] = build_clip_text_encoder(inference_backend)
+        except Exception as e:
+            model_status["clip_text"] = "failed"
+            logger.error(f"Failed to load CLIP text encoder: {e}")
+            return False
+        # The full model may have finished first; it serves queries from then on
+        if clip_model is None:
+            text_encoder = encoder
+        model_load_seconds["clip_text"] = round(time.perf_counter() - started, 2)
+        model_status["clip_text"] = "ready"
+        logger.info(f"CLIP text encoder ready in {model_load_seconds['clip_text']}s")
         return True
-        
-    except Exception as e:
-        logger.error(f"Failed to load ML models: {e}")
-        return False
 
 
-def generate_image_embedding(image_path: str, max_retries: int = 1) -> Optional[np.ndarray]:
-    """Generate CLIP embedding for an image"""
-    if clip_model is None:
-        logger.error("CLIP model not loaded")
-        return None
-    
-    for attempt in range(max_retries + 1):
+def load_clip() -> bool:
+    """Load CLIP (text + image embeddings); idempotent and thread-safe"""
+    global clip_model, clip_encoder, text_encoder
+    with _load_locks["clip"]:
+        if clip_model is not None:
+            return True
+        model_status["clip"] = "loading"
+        started = time.perf_counter()
         try:
-            # Load and process image
-            image = Image.open(image_path).convert('RGB')
-
-            # Generate embedding
-            # SentenceTransformer expects list of PIL Images for CLIP
-            embedding = clip_model.encode([image], convert_to_numpy=True, normalize_embeddings=False)
-            if isinstance(embedding, list):
-                embedding = np.array(embedding)
-            # embedding shape: (1, 512) -> return 1D vector
-            return embedding[0]
-            
+            if serving_role == "search":
+                logger.info(f"Loading CLIP text encoder only ({inference_backend})...")
+                clip_encoder, active_backends["clip"] = build_clip_text_encoder(inference_backend)
+                clip_model = clip_encoder.model
+            else:
+                logger.info(f"Loading CLIP model ({inference_backend})...")
+                model = SentenceTransformer('clip-ViT-B-32')
+                clip_encoder, active_backends["clip"] = build_clip_encoder(model, inference_backend)
+                clip_model = model
+                # Queries move to the full model; drop the interim text tower
+                text_encoder = None
         except Exception as e:
-            logger.warning(f"CLIP embedding attempt {attempt + 1} failed: {e}")
-            if attempt == max_retries:
-                logger.error(f"CLIP failed to process {image_path} after {max_retries + 1} attempts")
-                return None
-    
-    return None
+            model_status["clip"] = "failed"
+            logger.error(f"Failed to load CLIP model: {e}")
+            return False
+        model_load_seconds["clip"] = round(time.perf_counter() - started, 2)
+        model_status["clip"] = "ready"
+        logger.info(f"CLIP model ready in {model_load_seconds['clip']}s")
+        return True
 
 
-def generate_image_caption(image_path: str, max_retries: int = 1) -> Optional[str]:
-    """Generate BLIP caption for an image"""
-    if blip_model is None or blip_processor is None:
-        logger.error("BLIP model not loaded")
-        return None
-    
-    for attempt in range(max_retries + 1):
+def load_blip() -> bool:
+    """Load BLIP captioning; idempotent and thread-safe"""
+    global blip_processor, blip_model
+    with _load_locks["blip"]:
+        if blip_model is not None and blip_processor is not None:
+            return True
+        model_status["blip"] = "loading"
+        started = time.perf_counter()
         try:
-            # Load and process image
-            image = Image.open(image_path).convert('RGB')
-            
-            # Generate caption
-            inputs = blip_processor(image, return_tensors="pt")
-            out = blip_model.generate(**inputs, max_length=50)
-            caption = blip_processor.decode(out[0], skip_special_tokens=True)
-            
-            return caption
-            
+            logger.info(f"Loading BLIP model ({inference_backend})...")
+            processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+            model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+            model, active_backends["blip"] = build_blip(model.eval(), inference_backend)
         except Exception as e:
-            logger.warning(f"BLIP caption attempt {attempt + 1} failed: {e}")
-            if attempt == max_retries:
-                logger.error(f"BLIP failed to process {image_path} after {max_retries + 1} attempts")
-                return None
-    
-    return None
+            model_status["blip"] = "failed"
+            logger.error(f"Failed to load BLIP model: {e}")
+            return False
+        blip_processor, blip_model = processor, model
+        model_load_seconds["blip"] = round(time.perf_counter() - started, 2)
+        model_status["blip"] = "ready"
+        logger.info(f"BLIP model ready in {model_load_seconds['blip']}s")
+        return True
 
 
-def generate_text_embedding(text: str) -> Optional[np.ndarray]:
-    """Generate CLIP embedding for text query"""
-    if clip_model is None:
+def ensure_clip() -> bool:
+    """Block until CLIP is loaded (loading it now if nobody has)"""
+    return clip_model is not None or load_clip()
+
+
+def ensure_blip() -> bool:
+    """Block until BLIP is loaded (loading it now if nobody has)"""
+    return (blip_model is not None and blip_processor is not None) or load_blip()
+
+
+def load_models():
+    """Initialize CLIP and BLIP models"""
+    _register_heif()
+    clip_loaded = load_clip()
+    blip_loaded = load_blip()
+    if clip_loaded and blip_loaded:
+        logger.info("All ML models loaded successfully!")
+    return clip_loaded and blip_loaded
+
+
+def load_staged(blip_mode: str = "background") -> None:
+    """CLIP first so search can serve; then BLIP unless it is deferred to first use"""
+    _register_heif()
+    if serving_role == "search":
+        # load_clip builds just the text tower here
+        model_status["clip_text"] = "disabled"
+        load_clip()
+        model_status["blip"] = "disabled"
+        return
+    if serving_role == "all":
+        # The text tower loads in a fraction of the full model's time, so search is
+        # ready as soon as on a search replica; the full CLIP model then replaces it
+        load_clip_text()
+    else:
+        model_status["clip_text"] = "disabled"
+    load_clip()
+    if blip_mode != "lazy":
+        load_blip()
+
+
+def can_encode_text() -> bool:
+    """Whether search queries can be embedded yet"""
+    return clip_model is not None or text_encoder is not None
+
+
+def capabilities() -> dict:
+    """What this process can serve right now"""
+    full_clip = clip_model is not None and serving_role != "search"
+    return {
+        "search": can_encode_text(),
+        "captioning": blip_model is not None,
+        "ingest": full_clip and blip_model is not None,
+        "serving_role": serving_role,
+        "models": dict(model_status),
+        "load_seconds": dict(model_load_seconds),
+        "inference_backend": inference_backend,
+        "active_backends": dict(active_backends),
+    }
+
+
+def generate_text_embeddings(texts: List[str]) -> Optional[np.ndarray]:
+    """Generate CLIP embeddings for a batch of text queries in one forward pass"""
+    # Read once: load_clip swaps the interim text tower for the full model
+    encoder = text_encoder or (clip_encoder if clip_model is not None else None)
+    if encoder is None:
         logger.error("CLIP model not loaded")
         return None
-    
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+
     try:
-        # Generate text embedding using same CLIP model
-        embedding = clip_model.encode(text, convert_to_numpy=True, normalize_embeddings=False)
-        return embedding if isinstance(embedding, np.ndarray) else np.array(embedding)
-        
+        return encoder.encode_text(texts)
+
     except Exception as e:
-        logger.error(f"Failed to generate text embedding for '{text}': {e}")
-        return None 
+        logger.error(f"Failed to generate text embeddings for {len(texts)} queries: {e}")
+        return None
+
+
+def generate_image_embeddings(images: List[Image.Image]) -> Optional[np.ndarray]:
+    """Generate CLIP embeddings for a batch of already-decoded RGB images"""
+    if not ensure_clip():
+        logger.error("CLIP model not loaded")
+        return None
+    if not images:
+        return np.empty((0, 0), dtype=np.float32)
+
+    try:
+        # One forward pass over the whole batch
+        embeddings = clip_encoder.encode_images(images)
+        # embeddings shape: (len(images), 512)
+        return embeddings
+
+    except Exception as e:
+        logger.error(f"CLIP batch embedding failed for {len(images)} images: {e}")
+        return None
+
+
+def generate_image_captions(images: List[Image.Image], max_length: int = 50) -> Optional[List[str]]:
+    """Generate BLIP captions for a batch of already-decoded RGB images"""
+    # BLIP may still be loading (or deferred until now); ingestion can wait for it
+    if serving_role == "search":
+        logger.error("BLIP is not loaded on search replicas (SERVING_ROLE=search)")
+        return None
+    if not ensure_blip():
+        logger.error("BLIP model not loaded")
+        return None
+    if not images:
+        return []
+
+    try:
+        # Single padded batch through the processor and one generate() call
+        inputs = blip_processor(images=images, return_tensors="pt")
+        with torch.no_grad():
+            out = blip_model.generate(**inputs, max_length=max_length)
+        return blip_processor.batch_decode(out, skip_special_tokens=True)
+
+    except Exception as e:
+        logger.error(f"BLIP batch captioning failed for {len(images)} images: {e}")
+        return None
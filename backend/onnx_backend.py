@@ -0,0 +1,113 @@
+import logging
+import os
+from typing import List
+
+import numpy as np
+
+"""ONNX Runtime CPU execution of the CLIP text and image towers"""
+
+logger = logging.getLogger(__name__)
+
+
+def _default_cache_dir() -> str:
+    data_dir = "/app/data" if os.path.exists("/app") else "./data"
+    return os.path.join(data_dir, "onnx")
+
+
+class OnnxClip:
+    """CLIP encoder with the same outputs as SentenceTransformer('clip-ViT-B-32')
+
+    The towers are exported once from the loaded PyTorch model into cache_dir
+    (optionally int8-quantized) and reused on later starts. Preprocessing
+    still goes through the Hugging Face processor, so inputs match exactly.
+    """
+
+    def __init__(self, sentence_transformer, cache_dir: str = None, threads: int = 0, int8: bool = False):
+        import onnxruntime as ort
+
+        clip_module = sentence_transformer[0]
+        self.hf_model = clip_module.model
+        self.processor = clip_module.processor
+        self.cache_dir = cache_dir or _default_cache_dir()
+        self.int8 = int8
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        text_path, vision_path = self._export()
+        options = ort.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.text_session = ort.InferenceSession(text_path, options, providers=providers)
+        self.vision_session = ort.InferenceSession(vision_path, options, providers=providers)
+
+    def _export(self):
+        import torch
+
+        suffix = ".int8.onnx" if self.int8 else ".onnx"
+        text_path = os.path.join(self.cache_dir, "clip_text" + suffix)
+        vision_path = os.path.join(self.cache_dir, "clip_vision" + suffix)
+        if os.path.exists(text_path) and os.path.exists(vision_path):
+            return text_path, vision_path
+
+        hf_model = self.hf_model.eval()
+
+        class _Text(torch.nn.Module):
+            def forward(self, input_ids, attention_mask):
+                return hf_model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+        class _Vision(torch.nn.Module):
+            def forward(self, pixel_values):
+                return hf_model.get_image_features(pixel_values=pixel_values)
+
+        fp32_text = os.path.join(self.cache_dir, "clip_text.onnx")
+        fp32_vision = os.path.join(self.cache_dir, "clip_vision.onnx")
+        tokens = self.processor.tokenizer(["a photo"], padding=True, return_tensors="pt")
+        pixels = torch.zeros(1, 3, 224, 224)
+        with torch.no_grad():
+            if not os.path.exists(fp32_text):
+                logger.info("Exporting CLIP text tower to ONNX...")
+                torch.onnx.export(
+                    _Text(), (tokens["input_ids"], tokens["attention_mask"]), fp32_text + ".tmp",
+                    input_names=["input_ids", "attention_mask"], output_names=["embeds"],
+                    dynamic_axes={
+                        "input_ids": {0: "batch", 1: "sequence"},
+                        "attention_mask": {0: "batch", 1: "sequence"},
+                        "embeds": {0: "batch"},
+                    },
+                    opset_version=14,
+                )
+                os.replace(fp32_text + ".tmp", fp32_text)
+            if not os.path.exists(fp32_vision):
+                logger.info("Exporting CLIP vision tower to ONNX...")
+                torch.onnx.export(
+                    _Vision(), (pixels,), fp32_vision + ".tmp",
+                    input_names=["pixel_values"], output_names=["embeds"],
+                    dynamic_axes={"pixel_values": {0: "batch"}, "embeds": {0: "batch"}},
+                    opset_version=14,
+                )
+                os.replace(fp32_vision + ".tmp", fp32_vision)
+
+        if not self.int8:
+            return fp32_text, fp32_vision
+
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        for source, target in ((fp32_text, text_path), (fp32_vision, vision_path)):
+            logger.info(f"Quantizing {os.path.basename(source)} to int8...")
+            quantize_dynamic(source, target + ".tmp", weight_type=QuantType.QInt8)
+            os.replace(target + ".tmp", target)
+        return text_path, vision_path
+
+    def encode_text(self, texts: List[str]) -> np.ndarray:
+        tokens = self.processor.tokenizer(
+            texts, padding=True, truncation=True, max_length=77, return_tensors="np"
+        )
+        inputs = {
+            "input_ids": tokens["input_ids"].astype(np.int64),
+            "attention_mask": tokens["attention_mask"].astype(np.int64),
+        }
+        return self.text_session.run(["embeds"], inputs)[0]
+
+    def encode_images(self, images) -> np.ndarray:
+        pixels = self.processor.image_processor(images, return_tensors="np")["pixel_values"]
+        return self.vision_session.run(["embeds"], {"pixel_values": pixels.astype(np.float32)})[0]
@@ -0,0 +1,396 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from PIL import Image as PILImage
+
+from database import SessionLocal, Image
+from embedding_store import EmbeddingStore
+from faiss_manager import FAISSManager
+from dedup import content_hash
+from image_pipeline import decode_image, perceptual_hash
+from ingest_worker import read_original
+import ml_models
+import storage
+
+"""Offline full re-embed (and optional re-caption) of the images table
+
+Builds a fresh embedding store and FAISS index next to the live ones, then
+swaps them in with os.replace. Progress is checkpointed after every batch so
+a killed run picks up where it stopped:
+
+    python reindex.py                 # re-embed everything, then swap
+    python reindex.py --captions      # also regenerate BLIP captions
+    python reindex.py --no-swap       # build only; swap later with --swap-only
+    python reindex.py --restart       # discard a previous partial run
+
+Right before the swap, rows ingested since the embed phase passed them are
+embedded and rows deleted during the run are dropped, so the new index covers
+exactly the images table. Stop the API writer before swapping (it owns the
+live log and snapshots) and restart it afterwards so it loads the new index
+and the new model; the swap is refused while the table is still changing.
+"""
+
+logger = logging.getLogger("reindex")
+
+CHECKPOINT_VERSION = 1
+
+
+def _default_index_path() -> str:
+    index_path = os.getenv("FAISS_INDEX_PATH")
+    if index_path:
+        return index_path
+    data_dir = "/app/data" if os.path.exists("/app") else "./data"
+    return os.path.join(data_dir, "faiss_index.index")
+
+
+def _decode_worker_init() -> None:
+    try:
+        from pillow_heif import register_heif_opener
+        register_heif_opener()
+    except Exception:
+        pass
+
+
+def _decode(content: Optional[bytes]) -> Optional[Tuple[Tuple[int, int], bytes, str]]:
+    """Runs in a worker process: bytes -> downscaled RGB pixels (cheap to pickle back) and SHA-256"""
+    if not content:
+        return None
+    try:
+        image = decode_image(content)
+        return image.size, image.tobytes(), content_hash(content)
+    except Exception:
+        return None
+
+
+class Checkpoint:
+    """JSON progress file, replaced atomically after every committed batch"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.state = {}
+
+    def load(self) -> bool:
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            self.state = json.load(f)
+        return self.state.get("version") == CHECKPOINT_VERSION
+
+    def save(self, **changes) -> None:
+        self.state.update(changes, version=CHECKPOINT_VERSION, updated_at=time.time())
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+
+class Reindexer:
+    def __init__(self, args):
+        self.args = args
+        self.index_path = args.index_path
+        self.staging_dir = args.staging_dir or os.path.join(os.path.dirname(self.index_path) or ".", "reindex")
+        os.makedirs(self.staging_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(self.index_path))[0]
+        self.staged_index_path = os.path.join(self.staging_dir, os.path.basename(self.index_path))
+        self.staged_store = EmbeddingStore(
+            os.path.join(self.staging_dir, f"{base}.embeddings.npy"), args.embedding_dim
+        )
+        # Same naming rule FAISSManager uses, so the swapped files are picked up as-is
+        self.live_store_path = os.getenv("EMBEDDING_STORE_PATH") or os.path.splitext(self.index_path)[0] + ".embeddings.npy"
+        self.checkpoint = Checkpoint(os.path.join(self.staging_dir, "checkpoint.json"))
+        self._models_loaded = False
+
+    # -- rows ---------------------------------------------------------------
+
+    def _rows(self, after_id: int) -> Iterator[List[Tuple[int, str]]]:
+        """Keyset-paginated (id, url) chunks; rows added mid-run are picked up at the end"""
+        while True:
+            db = SessionLocal()
+            try:
+                chunk = (
+                    db.query(Image.id, Image.s3_url)
+                    .filter(Image.id > after_id)
+                    .order_by(Image.id)
+                    .limit(self.args.batch_size)
+                    .all()
+                )
+            finally:
+                db.close()
+            if not chunk:
+                return
+            yield [(row.id, row.s3_url) for row in chunk]
+            after_id = chunk[-1].id
+
+    def _fetch_and_decode(self, downloads: ThreadPoolExecutor, decoders: ProcessPoolExecutor, chunk):
+        contents = list(downloads.map(read_original, [url for _, url in chunk]))
+        return list(decoders.map(_decode, contents))
+
+    # -- phases -------------------------------------------------------------
+
+    def embed(self) -> None:
+        last_id = self.checkpoint.get("last_id", 0)
+        processed = self.checkpoint.get("processed", 0)
+        failed = self.checkpoint.get("failed", [])
+        started = time.perf_counter()
+
+        with ThreadPoolExecutor(self.args.download_workers, thread_name_prefix="reindex-fetch") as downloads, \
+                ProcessPoolExecutor(self.args.decode_workers, initializer=_decode_worker_init) as decoders, \
+                ThreadPoolExecutor(1, thread_name_prefix="reindex-prefetch") as prefetch:
+            pending = None
+            # Keep one chunk downloading/decoding while the previous one is on the model
+            for chunk in self._rows(last_id):
+                future = prefetch.submit(self._fetch_and_decode, downloads, decoders, chunk)
+                if pending is not None:
+                    processed, failed = self._process(*pending, processed, failed, started)
+                pending = (chunk, future)
+            if pending is not None:
+                processed, failed = self._process(*pending, processed, failed, started)
+
+        self.checkpoint.save(phase="embedded", processed=processed, failed=failed)
+        logger.info(f"Embedded {processed} images ({len(failed)} failed)")
+
+    def _process(self, chunk, future, processed: int, failed: List[int], started: float):
+        ids, chunk_failed = self._embed_chunk(chunk, future.result())
+        failed.extend(chunk_failed)
+        processed += len(ids)
+        # Everything up to here is flushed, so a resume can skip it
+        self.checkpoint.save(last_id=chunk[-1][0], processed=processed, failed=failed)
+        elapsed = time.perf_counter() - started
+        logger.info(f"{processed} images re-embedded up to id {chunk[-1][0]} ({processed / max(elapsed, 1e-9):.1f}/s)")
+        return processed, failed
+
+    def _embed_chunk(self, chunk, decoded_chunk) -> Tuple[List[int], List[int]]:
+        """Embed decoded rows into the staged store (and refresh their hashes); (embedded, failed) ids"""
+        ids, images, hashes, failed = [], [], [], []
+        for (image_id, _), decoded in zip(chunk, decoded_chunk):
+            if decoded is None:
+                failed.append(image_id)
+                continue
+            size, pixels, sha256 = decoded
+            image = PILImage.frombytes("RGB", size, pixels)
+            ids.append(image_id)
+            images.append(image)
+            hashes.append((sha256, perceptual_hash(image)))
+
+        if images:
+            embeddings = ml_models.generate_image_embeddings(images)
+            if embeddings is None:
+                raise RuntimeError(f"CLIP failed on batch ending at id {chunk[-1][0]}")
+            embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+            faiss.normalize_L2(embeddings)
+            self.staged_store.put(ids, embeddings)
+
+            # The originals are in hand anyway, so (re)fill the dedup hashes as we go
+            updates = [
+                {"id": i, "content_sha256": sha256, "phash": phash}
+                for i, (sha256, phash) in zip(ids, hashes)
+            ]
+            if self.args.captions:
+                captions = ml_models.generate_image_captions(images)
+                if captions is not None:
+                    for update, caption in zip(updates, captions):
+                        update["caption"] = caption
+            db = SessionLocal()
+            try:
+                db.bulk_update_mappings(Image, updates)
+                db.commit()
+            finally:
+                db.close()
+        return ids, failed
+
+    def build(self) -> None:
+        staged = FAISSManager(
+            embedding_dim=self.args.embedding_dim,
+            index_path=self.staged_index_path,
+            index_type=self.args.index_type,
+            store_path=self.staged_store.path,
+        )
+        if not staged.rebuild_from_store(persist=False):
+            raise RuntimeError("Building the new index failed")
+        tmp_path = self.staged_index_path + ".tmp"
+        faiss.write_index(staged.index, tmp_path)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.staged_index_path)
+        self.checkpoint.save(phase="built", ntotal=int(staged.index.ntotal), index_type=staged.active_index_type)
+        logger.info(f"Built {staged.active_index_type} index with {staged.index.ntotal} vectors")
+
+    def _table_ids(self) -> np.ndarray:
+        db = SessionLocal()
+        try:
+            return np.array(sorted(row.id for row in db.query(Image.id).all()), dtype=np.int64)
+        finally:
+            db.close()
+
+    def _embed_ids(self, image_ids: List[int]) -> List[int]:
+        """Embed specific rows into the staged store; returns the ids that failed"""
+        if not self._models_loaded:
+            if not ml_models.load_models():
+                raise RuntimeError("Failed to load models")
+            self._models_loaded = True
+        failed = []
+        with ThreadPoolExecutor(self.args.download_workers, thread_name_prefix="reindex-fetch") as downloads, \
+                ProcessPoolExecutor(self.args.decode_workers, initializer=_decode_worker_init) as decoders:
+            for start in range(0, len(image_ids), self.args.batch_size):
+                batch = image_ids[start:start + self.args.batch_size]
+                db = SessionLocal()
+                try:
+                    chunk = [(row.id, row.s3_url) for row in db.query(Image.id, Image.s3_url).filter(Image.id.in_(batch)).order_by(Image.id)]
+                finally:
+                    db.close()
+                if chunk:
+                    failed.extend(self._embed_chunk(chunk, self._fetch_and_decode(downloads, decoders, chunk))[1])
+        return failed
+
+    def catch_up(self) -> bool:
+        """Make the staged store hold exactly the ids in the images table
+
+        Rows ingested after the embed phase passed them are embedded now, rows
+        deleted during the run are dropped, and the index is rebuilt if either
+        happened. Rows that still cannot be decoded keep their live vector.
+        False (swap refused) if the table changed again meanwhile.
+        """
+        table_ids = self._table_ids()
+        staged_ids = self.staged_store.ids()
+        deleted = np.setdiff1d(staged_ids, table_ids)
+        missing = np.setdiff1d(table_ids, staged_ids)
+        unrecoverable = np.empty(0, dtype=np.int64)
+        if len(deleted):
+            self.staged_store.delete(deleted)
+        if len(missing):
+            logger.info(f"Catching up {len(missing)} images not in the staged index")
+            failed = np.array(self._embed_ids(missing.tolist()), dtype=np.int64)
+            if len(failed):
+                live = EmbeddingStore(self.live_store_path, self.args.embedding_dim, read_only=True)
+                vectors, found = live.get(failed)
+                self.staged_store.put(failed[found], vectors[found])
+                unrecoverable = failed[~found]
+                if len(unrecoverable):
+                    logger.warning(f"{len(unrecoverable)} images could not be embedded and have no live vector")
+        if len(deleted) or len(missing):
+            logger.info(f"Dropped {len(deleted)} deleted and added {len(missing)} new images; rebuilding")
+            self.build()
+
+        expected = np.setdiff1d(self._table_ids(), unrecoverable)
+        if not np.array_equal(expected, self.staged_store.ids()):
+            logger.error(
+                "The images table changed while catching up; stop the API writer and "
+                "run again with --swap-only"
+            )
+            return False
+        return True
+
+    def swap(self) -> None:
+        """Move staged files over the live ones; safe to re-run if interrupted"""
+        self.checkpoint.save(phase="swapping")
+        moves = [
+            (self.staged_store.path, self.live_store_path),
+            (self.staged_store.mask_path, os.path.splitext(self.live_store_path)[0] + ".present.npy"),
+            # The index goes last: it is what the API loads first on restart
+            (self.staged_index_path, self.index_path),
+        ]
+        for src, dst in moves:
+            if os.path.exists(src):
+                os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+                os.replace(src, dst)
+
+        # Logged vectors and tombstones describe the old embeddings; replaying them
+        # on top of the new index would undo the reindex
+        for stale in [self.index_path + ".log", self.index_path + ".log.1"] + glob.glob(
+            glob.escape(self.index_path) + ".tombstones.*.npy"
+        ):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+        s3_key = os.getenv("S3_FAISS_KEY")
+        if s3_key and storage.s3_storage is not None:
+            storage.s3_storage.put_file(s3_key, self.index_path, public=False)
+        self.checkpoint.save(phase="done")
+        logger.info(f"Swapped new index into {self.index_path}; restart the API to pick it up")
+
+    def run(self) -> int:
+        if self.args.restart:
+            shutil.rmtree(self.staging_dir, ignore_errors=True)
+            os.makedirs(self.staging_dir, exist_ok=True)
+
+        if self.checkpoint.load():
+            if self.checkpoint.get("captions") != self.args.captions:
+                logger.error("Checkpoint was started with a different --captions setting; use --restart")
+                return 2
+            logger.info(f"Resuming reindex from checkpoint (phase {self.checkpoint['phase']})")
+        else:
+            self.checkpoint.state = {}
+            self.checkpoint.save(phase="embedding", last_id=0, processed=0, failed=[], captions=self.args.captions)
+
+        phase = self.checkpoint["phase"]
+        if self.args.swap_only:
+            if phase not in ("built", "swapping"):
+                logger.error(f"Nothing to swap; reindex is in phase '{phase}'")
+                return 2
+        else:
+            if phase == "done":
+                logger.info("Previous reindex already completed; use --restart to run again")
+                return 0
+            if phase == "embedding":
+                if not ml_models.load_models():
+                    logger.error("Failed to load models")
+                    return 1
+                self._models_loaded = True
+                self.embed()
+                phase = "embedded"
+            if phase == "embedded":
+                self.build()
+                phase = "built"
+            if phase == "built" and self.args.no_swap:
+                logger.info(f"New index staged in {self.staging_dir}; run with --swap-only to activate it")
+                return 0
+
+        # An interrupted swap has already moved staged files; only check before it starts
+        if phase == "built" and not self.catch_up():
+            return 2
+        self.swap()
+        return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Re-embed every image and rebuild the FAISS index")
+    parser.add_argument("--index-path", default=_default_index_path())
+    parser.add_argument("--staging-dir", default=None, help="where the new index is built (default: <index dir>/reindex)")
+    parser.add_argument("--index-type", default=None, help="flat | hnsw | ivf | ivfpq | auto (default: FAISS_INDEX_TYPE)")
+    parser.add_argument("--embedding-dim", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("INFERENCE_BATCH_SIZE", "8")) * 4)
+    parser.add_argument("--download-workers", type=int, default=16)
+    parser.add_argument("--decode-workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--captions", action="store_true", help="regenerate BLIP captions as well")
+    parser.add_argument("--no-swap", action="store_true", help="stop after building the staged index")
+    parser.add_argument("--swap-only", action="store_true", help="activate a previously built staged index")
+    parser.add_argument("--restart", action="store_true", help="discard any checkpoint and start over")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    return Reindexer(args).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
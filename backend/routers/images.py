@@ -1,39 +1,239 @@
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Depends, HTTPException, Query, UploadFile, File
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
-from database import get_db, Image
+from database import get_db, Image, count_images
+from routers.auth import verify_admin_session
+from routers.upload import validate_image_file, ALLOWED_EXTENSIONS, _max_file_size_bytes
+from inference_pool import ingest_pool, PoolSaturatedError
+from ingest_worker import aread_original, adelete_original, astore_image
+import ml_models
+from ml_models import generate_image_embeddings, generate_image_captions
+from image_pipeline import (
+    MODEL_SIDE, decode_image, derivative_decode_side, exif_orientation, make_derivatives, perceptual_hash, shrink,
+)
+from dedup import dedup, content_hash
+from metadata_cache import metadata_cache, image_to_dict
+from datetime import datetime
+from typing import Optional
+import asyncio
+import base64
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
+# Only what a gallery tile needs; no ORM identity-map overhead
+_LIST_COLUMNS = (
+    Image.id, Image.filename, Image.caption, Image.s3_url, Image.thumb_url, Image.preview_url, Image.uploaded_at,
+)
+
+
+def require_write_role():
+    """Index writes happen on ingest/all replicas; search replicas only read"""
+    if ml_models.serving_role == "search":
+        raise HTTPException(status_code=503, detail="This replica only serves search (SERVING_ROLE=search)")
+    return True
+
+
+def _encode_cursor(uploaded_at: datetime, image_id: int) -> str:
+    raw = f"{uploaded_at.isoformat()}|{image_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        uploaded_at, _, image_id = raw.rpartition("|")
+        return datetime.fromisoformat(uploaded_at), int(image_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
 @router.get("/")
 async def list_images(
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="next_cursor from a previous page (overrides page)"),
     db: Session = Depends(get_db),
 ):
-    total = db.query(Image).count()
-    offset = (page - 1) * page_size
-    rows = (
-        db.query(Image)
-        .order_by(Image.uploaded_at.desc())
-        .offset(offset)
-        .limit(page_size)
-        .all()
-    )
-    items = [
-        {
-            "id": r.id,
-            "filename": r.filename,
-            "caption": r.caption,
-            "s3_url": r.s3_url,
-            "uploaded_at": r.uploaded_at.isoformat() if r.uploaded_at else None,
-        }
-        for r in rows
-    ]
+    """Newest-first gallery listing; follow next_cursor for constant-cost deep pages"""
+    total = count_images(db)
+    query = db.query(*_LIST_COLUMNS).order_by(Image.uploaded_at.desc(), Image.id.desc())
+    if cursor:
+        # Keyset seek on (uploaded_at, id) via ix_images_uploaded_at_id
+        uploaded_at, image_id = _decode_cursor(cursor)
+        query = query.filter(
+            or_(
+                Image.uploaded_at < uploaded_at,
+                and_(Image.uploaded_at == uploaded_at, Image.id < image_id),
+            )
+        )
+    else:
+        query = query.offset((page - 1) * page_size)
+    # One extra row tells us whether another page exists
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    items = [image_to_dict(r) for r in rows]
+    last = rows[-1] if rows else None
     return {
         "items": items,
         "page": page,
         "page_size": page_size,
         "total": total,
+        "has_more": has_more,
+        "next_cursor": _encode_cursor(last.uploaded_at, last.id) if has_more and last.uploaded_at else None,
     }
 
+
+def _get_image_or_404(db: Session, image_id: int) -> Image:
+    image = db.query(Image).filter(Image.id == image_id).first()
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return image
+
+
+def _embed_and_caption(content: bytes, with_caption: bool):
+    """One decode -> (embedding, caption, phash, derivatives); the last three only with_caption"""
+    if not with_caption:
+        embeddings = generate_image_embeddings([decode_image(content)])
+        return (embeddings[0] if embeddings is not None and len(embeddings) else None), None, None, None
+    full = decode_image(content, derivative_decode_side())
+    image = shrink(full, MODEL_SIDE)
+    embeddings = generate_image_embeddings([image])
+    captions = generate_image_captions([image])
+    embedding = embeddings[0] if embeddings is not None and len(embeddings) else None
+    caption = captions[0] if captions else None
+    return embedding, caption, perceptual_hash(image), make_derivatives(full, exif_orientation(content))
+
+
+@router.delete("/{image_id}")
+async def delete_image(
+    image_id: int,
+    db: Session = Depends(get_db),
+    _: bool = Depends(verify_admin_session),
+    __: bool = Depends(require_write_role),
+):
+    """Delete an image, its vector and its stored original (admin only)"""
+    from main import faiss_manager
+
+    image = _get_image_or_404(db, image_id)
+    stored_url = image.s3_url
+    derivative_urls = [url for url in (image.thumb_url, image.preview_url) if url]
+
+    # Commit first: if it fails the image is still whole. A vector left behind by a
+    # failed remove only points at a missing row, which search already skips
+    db.delete(image)
+    db.commit()
+    removed = faiss_manager.remove_embeddings([image_id])
+    metadata_cache.remove([image_id])
+    dedup.remove([image_id])
+
+    deleted = await asyncio.gather(*(adelete_original(url) for url in [stored_url] + derivative_urls))
+    if not deleted[0]:
+        logger.warning(f"Could not delete stored original for image {image_id}: {stored_url}")
+
+    return {"id": image_id, "deleted": True, "vectors_removed": removed}
+
+
+@router.post("/{image_id}/reembed")
+async def reembed_image(
+    image_id: int,
+    db: Session = Depends(get_db),
+    _: bool = Depends(verify_admin_session),
+    __: bool = Depends(require_write_role),
+):
+    """Recompute the CLIP vector from the stored original and replace it (admin only)"""
+    from main import faiss_manager
+
+    image = _get_image_or_404(db, image_id)
+    content = await aread_original(image.s3_url)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Stored original not found")
+
+    try:
+        embedding, _caption, _phash, _derivatives = await ingest_pool.run(_embed_and_caption, content, False)
+    except PoolSaturatedError:
+        raise HTTPException(status_code=429, detail="Ingestion is busy, please retry shortly")
+    except Exception as e:
+        logger.error(f"Re-embed decode failed for image {image_id}: {e}")
+        raise HTTPException(status_code=400, detail="Image could not be decoded")
+    if embedding is None:
+        raise HTTPException(status_code=500, detail="CLIP failed to process image")
+
+    if not faiss_manager.replace_embedding(embedding, image_id):
+        raise HTTPException(status_code=500, detail="Failed to update index")
+    return {"id": image_id, "reembedded": True}
+
+
+@router.put("/{image_id}")
+async def replace_image(
+    image_id: int,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    _: bool = Depends(verify_admin_session),
+    __: bool = Depends(require_write_role),
+):
+    """Replace an image's file, caption and vector while keeping its id (admin only)"""
+    from main import faiss_manager
+
+    image = _get_image_or_404(db, image_id)
+    if not validate_image_file(file):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file. Allowed: {', '.join(ALLOWED_EXTENSIONS)}, Max size: 10MB"
+        )
+    content = await file.read()
+    if len(content) > _max_file_size_bytes():
+        raise HTTPException(status_code=400, detail="File too large (max 10MB)")
+
+    try:
+        embedding, caption, phash, derivatives = await ingest_pool.run(_embed_and_caption, content, True)
+    except PoolSaturatedError:
+        raise HTTPException(status_code=429, detail="Ingestion is busy, please retry shortly")
+    except Exception as e:
+        logger.error(f"Replacement decode failed for image {image_id}: {e}")
+        raise HTTPException(status_code=400, detail="Image could not be decoded")
+    if embedding is None:
+        raise HTTPException(status_code=500, detail="CLIP failed to process image")
+
+    old_urls = [image.s3_url, image.thumb_url, image.preview_url]
+    try:
+        # A failed original takes its already-stored derivatives with it
+        stored_url, derivative_urls = await astore_image(content, file.filename, derivatives)
+    except Exception as e:
+        logger.error(f"Storing replacement for image {image_id} failed: {e}")
+        raise HTTPException(status_code=500, detail="Storing the replacement image failed")
+    new_urls = [stored_url] + list(derivative_urls.values())
+
+    # Swap the vector first and put the old one back if the row cannot be committed,
+    # so the row and its vector always describe the same file
+    old_vectors, found = faiss_manager.get_embeddings([image_id])
+    if not faiss_manager.replace_embedding(embedding, image_id):
+        await asyncio.gather(*(adelete_original(url) for url in new_urls))
+        raise HTTPException(status_code=500, detail="Failed to update index")
+    image.s3_url = stored_url
+    image.thumb_url = derivative_urls.get("thumb")
+    image.preview_url = derivative_urls.get("preview")
+    image.filename = file.filename
+    image.caption = caption or "Caption generation failed"
+    image.content_sha256 = content_hash(content)
+    image.phash = phash
+    try:
+        db.commit()
+    except Exception as e:
+        logger.error(f"Replacing image {image_id} failed, restoring its previous vector: {e}")
+        db.rollback()
+        if found[0]:
+            faiss_manager.replace_embedding(old_vectors[0], image_id)
+        await asyncio.gather(*(adelete_original(url) for url in new_urls))
+        raise HTTPException(status_code=500, detail="Failed to update image")
+    metadata_cache.put([image_to_dict(image)])
+    dedup.add([(image_id, phash)])
+
+    await asyncio.gather(*(adelete_original(url) for url in old_urls if url))
+
+    return {"id": image_id, "replaced": True, "caption": image.caption}
@@ -1,9 +1,19 @@
-from fastapi import APIRouter, Query, Depends
+from fastapi import APIRouter, Query, Depends, HTTPException
+from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from typing import Optional, List
-from database import get_db, Image
-from ml_models import generate_text_embedding
+from typing import Dict, Optional, List
+import database
+import ml_models
+from database import get_db, SessionLocal
+from inference_pool import PoolSaturatedError
+from text_batcher import text_batcher
+from search_cache import embedding_cache, result_cache, normalize_query
+from metadata_cache import metadata_cache
+from lexical_search import search_captions, reciprocal_rank_fusion
+import asyncio
+import base64
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -11,58 +21,211 @@ logger = logging.getLogger(__name__)
 router = APIRouter()
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+# Candidates fetched per k-NN call; deeper pages grow this in steps, up to the max
+SEARCH_CANDIDATES = max(1, _env_int("SEARCH_CANDIDATES", 100))
+SEARCH_MAX_DEPTH = max(SEARCH_CANDIDATES, _env_int("SEARCH_MAX_DEPTH", 1000))
+
+# Used when a request doesn't pass mode=; hybrid/lexical are opt-in and need the FTS5 caption index
+SEARCH_DEFAULT_MODE = os.getenv("SEARCH_DEFAULT_MODE", "vector").lower()
+if SEARCH_DEFAULT_MODE not in ("hybrid", "vector", "lexical"):
+    SEARCH_DEFAULT_MODE = "vector"
+
+# Field each mode's ranking score is returned in; similarity_score stays a cosine similarity
+SCORE_FIELDS = {"vector": "similarity_score", "lexical": "lexical_score", "hybrid": "fused_score"}
+
+
+def _encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(f"o:{offset}".encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, _, value = raw.partition(":")
+        if prefix != "o":
+            raise ValueError(raw)
+        return max(0, int(value))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _candidate_depth(needed: int) -> int:
+    """Round the depth a page needs up to a whole number of candidate blocks"""
+    blocks = -(-needed // SEARCH_CANDIDATES)
+    return min(SEARCH_MAX_DEPTH, blocks * SEARCH_CANDIDATES)
+
+
+async def _vector_candidates(faiss_manager, query_key: str, depth: int):
+    """Top `depth` k-NN hits for a text query, or None if it can't be embedded"""
+    query_embedding = embedding_cache.get(query_key)
+    if query_embedding is None:
+        # Generate embedding for search query, batched with concurrent queries
+        query_embedding = await text_batcher.embed(query_key)
+        if query_embedding is None:
+            return None
+        embedding_cache.set(query_key, query_embedding)
+
+    # Search FAISS index for similar images
+    return faiss_manager.search(query_embedding, top_k=depth)
+
+
+def _lexical_candidates(query_key: str, depth: int):
+    db = SessionLocal()
+    try:
+        return search_captions(db, query_key, depth)
+    finally:
+        db.close()
+
+
+async def _ranked_candidates(
+    faiss_manager, mode: str, query_key: str, needed: int, min_score: Optional[float], text_version: Optional[int] = None
+):
+    """Ranked (image_id, score) list for a query, deep enough to serve `needed` hits
+
+    Also returns image_id -> cosine similarity of the CLIP hits that fed a
+    hybrid ranking (empty for other modes). Both are cached per query, mode
+    and index version (plus the caption generation, `text_version`, for modes
+    that search captions), so paging doesn't re-run the searches. Returns None
+    if the query can't be served.
+    """
+    # Results are only valid for the index (and, for caption matches, the captions) they were computed against
+    index_version = faiss_manager.version if mode == "vector" else (faiss_manager.version, text_version)
+    # Hybrid applies the score floor before fusing, so it is part of the key
+    cache_key = (mode, query_key, min_score if mode == "hybrid" else None)
+    cached = result_cache.get(cache_key, version=index_version)
+    if cached is not None:
+        depth, exhausted, candidates, similarities = cached
+        # A score threshold may be met before reaching `needed` candidates
+        below_threshold = mode == "vector" and min_score is not None and candidates and candidates[-1][1] < min_score
+        if exhausted or below_threshold or len(candidates) >= min(needed, SEARCH_MAX_DEPTH):
+            return candidates, similarities
+
+    depth = _candidate_depth(needed)
+    similarities: Dict[int, float] = {}
+    if mode == "vector":
+        candidates = await _vector_candidates(faiss_manager, query_key, depth)
+        if candidates is None:
+            return None
+        exhausted = len(candidates) < depth
+    elif mode == "lexical":
+        # Keyword fast path: no text embedding, so no CLIP call
+        candidates = await asyncio.to_thread(_lexical_candidates, query_key, depth)
+        exhausted = len(candidates) < depth
+    else:
+        vector, lexical = await asyncio.gather(
+            _vector_candidates(faiss_manager, query_key, depth),
+            asyncio.to_thread(_lexical_candidates, query_key, depth),
+            return_exceptions=True,
+        )
+        if isinstance(lexical, Exception):
+            raise lexical
+        if isinstance(vector, Exception) and not isinstance(vector, PoolSaturatedError):
+            raise vector
+        if isinstance(vector, Exception) or vector is None:
+            # Encoder busy or failing: keyword matches are still worth returning
+            logger.warning(f"Hybrid search for '{query_key}' fell back to captions only")
+            vector = []
+            if not lexical:
+                return None
+        if min_score is not None:
+            vector = [hit for hit in vector if hit[1] >= min_score]
+        similarities = dict(vector)
+        candidates = reciprocal_rank_fusion([vector, lexical])
+        exhausted = len(vector) < depth and len(lexical) < depth
+
+    result_cache.set(cache_key, (depth, exhausted, candidates, similarities), version=index_version)
+    return candidates, similarities
+
+
 @router.get("/")
 async def search_images(
     q: str = Query(..., description="Search query"),
+    top_k: int = Query(5, ge=1, le=100, description="Results per page"),
+    offset: int = Query(0, ge=0, description="Results to skip"),
+    cursor: Optional[str] = Query(None, description="next_cursor from a previous page (overrides offset)"),
+    min_score: Optional[float] = Query(None, ge=-1.0, le=1.0, description="Minimum cosine similarity"),
+    mode: Optional[str] = Query(None, pattern="^(hybrid|vector|lexical)$", description="hybrid | vector | lexical"),
     db: Session = Depends(get_db)
 ):
     """
     Search for images using natural language
     
     - **q**: The search query (e.g., "sunset over mountains")
+    - **top_k**: Page size
+    - **offset** / **cursor**: Where the page starts
+    - **min_score**: Drop vector hits less similar than this (not used by lexical)
+    - **mode**: vector (CLIP, the default), lexical (caption/filename keywords) or hybrid (both, rank-fused)
+
+    similarity_score is always the CLIP cosine similarity (null for hits that
+    only matched captions). Lexical results are ranked by lexical_score (BM25,
+    higher is better) and hybrid results by fused_score (reciprocal rank fusion).
     """
     from main import faiss_manager
     
+    mode = mode or SEARCH_DEFAULT_MODE
+    if mode != "vector" and not database.fts_enabled:
+        mode = "vector"
+    if mode != "lexical" and not ml_models.can_encode_text():
+        # Text encoder still loading: serve keyword matches if we can, else ask to retry
+        if mode == "hybrid" and database.fts_enabled:
+            mode = "lexical"
+        else:
+            raise HTTPException(
+                status_code=503,
+                detail="Search model is still loading",
+                headers={"Retry-After": "5"},
+            )
+    if cursor:
+        offset = _decode_cursor(cursor)
+    
     try:
-        # Generate embedding for search query
-        query_embedding = generate_text_embedding(q)
-        if query_embedding is None:
+        query_key = normalize_query(q)
+        # Caption edits (from any process) don't touch the index, so lexical matches track them separately
+        text_version = database.caption_generation(db) if mode != "vector" else None
+        ranked = await _ranked_candidates(faiss_manager, mode, query_key, offset + top_k + 1, min_score, text_version)
+        if ranked is None:
             return {
                 "query": q,
                 "results": [],
                 "error": "Failed to process search query"
             }
+        candidates, similarities = ranked
+        if mode == "vector" and min_score is not None:
+            candidates = [hit for hit in candidates if hit[1] >= min_score]
         
-        # Search FAISS index for similar images
-        search_results = faiss_manager.search(query_embedding, top_k=5)
-        
-        if not search_results:
+        if not candidates:
             return {
                 "query": q,
                 "results": [],
                 "message": "No images found. Try uploading some images first!"
             }
         
+        page = candidates[offset:offset + top_k]
+        has_more = len(candidates) > offset + top_k
+        
         # Get image metadata from database
-        results = []
-        for image_id, similarity_score in search_results:
-            image = db.query(Image).filter(Image.id == image_id).first()
-            if image:
-                results.append({
-                    "id": image.id,
-                    "filename": image.filename,
-                    "caption": image.caption,
-                    "s3_url": image.s3_url,
-                    "uploaded_at": image.uploaded_at.isoformat(),
-                    "similarity_score": round(similarity_score, 3)
-                })
+        results = _hydrate(db, page, SCORE_FIELDS[mode], similarities)
         
         return {
             "query": q,
+            "mode": mode,
             "results": results,
-            "count": len(results)
+            "count": len(results),
+            "offset": offset,
+            "top_k": top_k,
+            "has_more": has_more,
+            "next_cursor": _encode_cursor(offset + top_k) if has_more else None
         }
         
+    except PoolSaturatedError:
+        raise HTTPException(status_code=429, detail="Search is busy, please retry shortly")
     except Exception as e:
         logger.error(f"Search failed for query '{q}': {e}")
         return {
@@ -72,12 +235,99 @@ async def search_images(
         }
 
 
+# Cap on ids per batch similarity request ("more like this" rails)
+MAX_SIMILAR_BATCH = _env_int("MAX_SIMILAR_BATCH", 100)
+
+
+class SimilarBatchRequest(BaseModel):
+    image_ids: List[int]
+    top_k: int = 10
+
+
+def _hydrate(
+    db: Session, hits, score_field: str = "similarity_score", similarities: Optional[Dict[int, float]] = None
+) -> List[dict]:
+    """Attach image metadata to (image_id, score) hits, keeping their order
+
+    The score goes in `score_field`; when that isn't similarity_score, the
+    cosine similarity (from `similarities`, else null) is returned alongside.
+    """
+    from main import faiss_manager
+
+    # Cached rows plus at most one IN (...) query for the rest; a re-mapped snapshot drops the cache
+    metadata = metadata_cache.get_many(db, [image_id for image_id, _ in hits], generation=faiss_manager.loads)
+    results = []
+    for image_id, score in hits:
+        entry = metadata.get(image_id)
+        if not entry:
+            continue
+        if score_field == "similarity_score":
+            results.append({**entry, "similarity_score": round(score, 3)})
+            continue
+        similarity = (similarities or {}).get(image_id)
+        results.append({
+            **entry,
+            # RRF sums of 1/(60 + rank) differ in the fourth decimal
+            score_field: round(score, 4 if score_field == "fused_score" else 3),
+            "similarity_score": round(similarity, 3) if similarity is not None else None,
+        })
+    return results
+
+
 @router.get("/similar/{image_id}")
-async def find_similar_images(image_id: int):
-    """Find images similar to a specific image"""
-    # TODO: Implement similarity search
+async def find_similar_images(
+    image_id: int,
+    top_k: int = Query(10, ge=1, le=100, description="Number of similar images"),
+    db: Session = Depends(get_db)
+):
+    """Find images similar to a specific image, using its stored vector"""
+    from main import faiss_manager
+
+    hits = faiss_manager.search_similar([image_id], top_k=top_k)[0]
+    if hits is None:
+        raise HTTPException(status_code=404, detail="Image not found in search index")
+
+    results = _hydrate(db, hits)
     return {
         "image_id": image_id,
-        "similar_images": [],
-        "message": "Similar image search coming soon!"
-    } 
\ No newline at end of file
+        "similar_images": results,
+        "count": len(results)
+    }
+
+
+@router.post("/similar")
+async def find_similar_images_batch(
+    request: SimilarBatchRequest,
+    db: Session = Depends(get_db)
+):
+    """Similar images for many images at once, served by one multi-query search"""
+    from main import faiss_manager
+
+    if not request.image_ids:
+        return {"results": [], "missing": []}
+    if len(request.image_ids) > MAX_SIMILAR_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_SIMILAR_BATCH} image ids per request")
+    if not 1 <= request.top_k <= 100:
+        raise HTTPException(status_code=400, detail="top_k must be between 1 and 100")
+
+    # Duplicate ids are searched once
+    image_ids = list(dict.fromkeys(request.image_ids))
+    all_hits = faiss_manager.search_similar(image_ids, top_k=request.top_k)
+
+    results = []
+    missing = []
+    for image_id, hits in zip(image_ids, all_hits):
+        if hits is None:
+            missing.append(image_id)
+            continue
+        similar = _hydrate(db, hits)
+        results.append({
+            "image_id": image_id,
+            "similar_images": similar,
+            "count": len(similar)
+        })
+
+    return {
+        "results": results,
+        "missing": missing
+    }
@@ -0,0 +1,84 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+"""Bounded LRU/TTL caches for query embeddings and search results"""
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+def normalize_query(q: str) -> str:
+    """Case- and whitespace-insensitive cache key for a text query"""
+    return " ".join(q.lower().split())
+
+
+class LRUCache:
+    """Thread-safe LRU cache with per-entry TTL and optional version tagging"""
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = max(0, maxsize)
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, version: Optional[int] = None) -> Optional[Any]:
+        """Return the cached value, or None if missing, expired or from another version"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, entry_version, value = entry
+                if expires_at >= time.monotonic() and (version is None or entry_version == version):
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None) -> None:
+        if self.maxsize == 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl_seconds, version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# normalized query text -> CLIP text embedding (independent of index contents)
+embedding_cache = LRUCache(
+    maxsize=_env_int("QUERY_CACHE_SIZE", 2048),
+    ttl_seconds=_env_int("QUERY_CACHE_TTL_S", 3600),
+)
+
+# normalized query text -> (depth, ranked [(image_id, score)]), tagged with the index
+# version; pages of the same query are sliced from it
+result_cache = LRUCache(
+    maxsize=_env_int("RESULT_CACHE_SIZE", 2048),
+    ttl_seconds=_env_int("RESULT_CACHE_TTL_S", 300),
+)
@@ -0,0 +1,416 @@
+import asyncio
+import functools
+import io
+import logging
+import os
+import shutil
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+"""Blob storage behind one interface: S3 (or an S3-compatible endpoint) and local uploads"""
+
+# Singletons below are configured at import (scripts import this before anything else)
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class Storage(ABC):
+    """Key -> bytes store with public URLs
+
+    Every method blocks; the a* variants run it on the backend's own thread
+    pool so async handlers never wait on disk or network I/O in the event loop.
+    """
+
+    remote = False
+
+    def __init__(self, io_threads: int):
+        self._executor = ThreadPoolExecutor(max(1, io_threads), thread_name_prefix=f"{type(self).__name__.lower()}-io")
+
+    @abstractmethod
+    def put_bytes(self, key: str, data: bytes, content_type: str = "application/octet-stream", public: bool = True) -> str:
+        ...
+
+    @abstractmethod
+    def put_file(self, key: str, path: str, content_type: Optional[str] = None, public: bool = True) -> str:
+        ...
+
+    @abstractmethod
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        ...
+
+    @abstractmethod
+    def get_file(self, key: str, path: str) -> bool:
+        ...
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def delete(self, key: str) -> bool:
+        ...
+
+    @abstractmethod
+    def url_for(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    def key_for(self, url: str) -> Optional[str]:
+        """Inverse of url_for; None when the URL does not belong to this store"""
+
+    def stats(self) -> dict:
+        return {"backend": type(self).__name__}
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Run a blocking storage call on this backend's I/O threads (from sync code)"""
+        return self._executor.submit(fn, *args, **kwargs)
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def aput_bytes(self, key: str, data: bytes, content_type: str = "application/octet-stream", public: bool = True) -> str:
+        return await self._run(self.put_bytes, key, data, content_type, public)
+
+    async def aget_bytes(self, key: str) -> Optional[bytes]:
+        return await self._run(self.get_bytes, key)
+
+    async def aexists(self, key: str) -> bool:
+        return await self._run(self.exists, key)
+
+    async def adelete(self, key: str) -> bool:
+        return await self._run(self.delete, key)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+
+class LocalStorage(Storage):
+    """Files under root, served by the app at url_prefix (StaticFiles mount)"""
+
+    def __init__(self, root: str, url_prefix: str = "/uploads/", io_threads: int = 8):
+        super().__init__(io_threads)
+        self.root = root
+        self.url_prefix = url_prefix
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Key escapes the storage root: {key}")
+        return path
+
+    def put_bytes(self, key: str, data: bytes, content_type: str = "application/octet-stream", public: bool = True) -> str:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return self.url_for(key)
+
+    def put_file(self, key: str, path: str, content_type: Optional[str] = None, public: bool = True) -> str:
+        """Copies `path` into the store; the source is left for the caller to remove"""
+        target = self._path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # A copy, not a rename: the spool and the uploads dir may be different mounts
+        shutil.copyfile(path, target + ".tmp")
+        os.replace(target + ".tmp", target)
+        return self.url_for(key)
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def get_file(self, key: str, path: str) -> bool:
+        data = self.get_bytes(key)
+        if data is None:
+            return False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return True
+
+    def exists(self, key: str) -> bool:
+        try:
+            return os.path.exists(self._path(key))
+        except ValueError:
+            return False
+
+    def delete(self, key: str) -> bool:
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def url_for(self, key: str) -> str:
+        return f"{self.url_prefix}{key}"
+
+    def key_for(self, url: str) -> Optional[str]:
+        if url and url.startswith(self.url_prefix):
+            return url[len(self.url_prefix):] or None
+        return None
+
+    def stats(self) -> dict:
+        return {"backend": "local", "root": self.root}
+
+
+class S3Storage(Storage):
+    """One shared boto3 client (thread-safe) with a sized connection pool
+
+    The pool matches the I/O thread count so concurrent transfers reuse warm
+    TLS connections instead of each call building a client and handshaking.
+    Files and large bodies go through the transfer manager: multipart above
+    the threshold, with parts in flight concurrently.
+    """
+
+    remote = True
+
+    def __init__(
+        self,
+        bucket: str,
+        region: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        public_base_url: Optional[str] = None,
+        max_pool_connections: int = 32,
+        multipart_threshold_mb: int = 8,
+        multipart_chunksize_mb: int = 8,
+        transfer_concurrency: int = 8,
+    ):
+        super().__init__(max_pool_connections)
+        self.bucket = bucket
+        self.region = region or "us-east-1"
+        self.endpoint_url = endpoint_url
+        self.public_base_url = (public_base_url or "").rstrip("/") or None
+        self.max_pool_connections = max_pool_connections
+        self._multipart_threshold = multipart_threshold_mb * MB
+        self._multipart_chunksize = multipart_chunksize_mb * MB
+        self._transfer_concurrency = transfer_concurrency
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+        self.clients_created = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["S3Storage"]:
+        """Configured from AWS_* / S3_* variables; None when S3 is not set up"""
+        bucket = os.getenv("S3_BUCKET_NAME")
+        endpoint_url = os.getenv("S3_ENDPOINT_URL") or None
+        # A custom endpoint (MinIO, LocalStack) does not need a real AWS region
+        if not (bucket and os.getenv("AWS_ACCESS_KEY_ID") and os.getenv("AWS_SECRET_ACCESS_KEY")):
+            return None
+        if not (os.getenv("AWS_REGION") or endpoint_url):
+            return None
+        return cls(
+            bucket=bucket,
+            region=os.getenv("AWS_REGION"),
+            endpoint_url=endpoint_url,
+            public_base_url=os.getenv("S3_PUBLIC_URL"),
+            max_pool_connections=_env_int("S3_MAX_POOL_CONNECTIONS", 32),
+            multipart_threshold_mb=_env_int("S3_MULTIPART_THRESHOLD_MB", 8),
+            multipart_chunksize_mb=_env_int("S3_MULTIPART_CHUNKSIZE_MB", 8),
+            transfer_concurrency=_env_int("S3_TRANSFER_CONCURRENCY", 8),
+        )
+
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    from botocore.config import Config
+
+                    config = Config(
+                        region_name=self.region,
+                        max_pool_connections=self.max_pool_connections,
+                        tcp_keepalive=True,
+                        retries={"max_attempts": 5, "mode": "standard"},
+                        # Stand-ins like MinIO serve buckets by path, not by subdomain
+                        s3={"addressing_style": "path"} if self.endpoint_url else None,
+                    )
+                    self._client = boto3.session.Session().client(
+                        "s3",
+                        endpoint_url=self.endpoint_url,
+                        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+                        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+                        config=config,
+                    )
+                    self.clients_created += 1
+        return self._client
+
+    def transfer_config(self):
+        if self._transfer_config is None:
+            from boto3.s3.transfer import TransferConfig
+
+            self._transfer_config = TransferConfig(
+                multipart_threshold=self._multipart_threshold,
+                multipart_chunksize=self._multipart_chunksize,
+                max_concurrency=self._transfer_concurrency,
+                use_threads=True,
+            )
+        return self._transfer_config
+
+    @staticmethod
+    def _extra(content_type: Optional[str], public: bool) -> dict:
+        extra = {}
+        if content_type:
+            extra["ContentType"] = content_type
+        if public:
+            extra["ACL"] = "public-read"
+        return extra
+
+    def put_bytes(self, key: str, data: bytes, content_type: str = "application/octet-stream", public: bool = True) -> str:
+        extra = self._extra(content_type, public)
+        if len(data) >= self._multipart_threshold:
+            self.client().upload_fileobj(io.BytesIO(data), self.bucket, key, ExtraArgs=extra, Config=self.transfer_config())
+        else:
+            # One request; no transfer-manager threads for a small body
+            self.client().put_object(Bucket=self.bucket, Key=key, Body=data, **extra)
+        return self.url_for(key)
+
+    def put_file(self, key: str, path: str, content_type: Optional[str] = None, public: bool = True) -> str:
+        extra = self._extra(content_type, public)
+        self.client().upload_file(path, self.bucket, key, ExtraArgs=extra or None, Config=self.transfer_config())
+        return self.url_for(key)
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client().get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except ClientError:
+            return None
+
+    def get_file(self, key: str, path: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # Ranged GETs in parallel for large objects (e.g. the FAISS snapshot)
+            self.client().download_file(self.bucket, key, path, Config=self.transfer_config())
+            return True
+        except ClientError:
+            return False
+
+    def exists(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client().head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, key: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client().delete_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError:
+            return False
+
+    def _url_prefixes(self) -> List[str]:
+        prefixes = []
+        if self.public_base_url:
+            prefixes.append(self.public_base_url + "/")
+        if self.endpoint_url:
+            prefixes.append(f"{self.endpoint_url.rstrip('/')}/{self.bucket}/")
+        prefixes.append(f"https://{self.bucket}.s3.amazonaws.com/")
+        prefixes.append(f"https://{self.bucket}.s3.{self.region}.amazonaws.com/")
+        return prefixes
+
+    def url_for(self, key: str) -> str:
+        if self.public_base_url:
+            return f"{self.public_base_url}/{key}"
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket}/{key}"
+        # Virtual-hosted–style URL
+        if self.region == "us-east-1":
+            return f"https://{self.bucket}.s3.amazonaws.com/{key}"
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def key_for(self, url: str) -> Optional[str]:
+        if not url:
+            return None
+        for prefix in self._url_prefixes():
+            if url.startswith(prefix):
+                return url[len(prefix):] or None
+        # Objects stored while the bucket was configured for another region
+        prefix = f"https://{self.bucket}.s3."
+        if url.startswith(prefix):
+            _, _, key = url[len(prefix):].partition(".amazonaws.com/")
+            return key or None
+        return None
+
+    def ensure_bucket(self) -> None:
+        """Create the bucket if missing (for local stand-ins; real buckets are provisioned)"""
+        if not self.exists_bucket():
+            self.client().create_bucket(Bucket=self.bucket)
+
+    def exists_bucket(self) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client().head_bucket(Bucket=self.bucket)
+            return True
+        except ClientError:
+            return False
+
+    def stats(self) -> dict:
+        return {
+            "backend": "s3",
+            "bucket": self.bucket,
+            "endpoint_url": self.endpoint_url,
+            "max_pool_connections": self.max_pool_connections,
+            "multipart_threshold_mb": self._multipart_threshold // MB,
+            "transfer_concurrency": self._transfer_concurrency,
+            "clients_created": self.clients_created,
+        }
+
+
+def _uploads_dir() -> str:
+    return "/app/uploads" if os.path.exists("/app") else "./uploads"
+
+
+# Index snapshots and offsite copies; None when S3 is not configured
+s3_storage: Optional[S3Storage] = S3Storage.from_env()
+# Local uploads are always readable: rows stored before S3 was configured point here
+local_storage = LocalStorage(_uploads_dir(), io_threads=_env_int("LOCAL_STORAGE_THREADS", 8))
+# Where new originals and derivatives go
+media_storage: Storage = s3_storage or local_storage
+
+
+def resolve(url: str) -> Tuple[Optional[Storage], Optional[str]]:
+    """(store, key) holding the object behind a stored URL, or (None, None)"""
+    for store in (local_storage, s3_storage):
+        if store is None:
+            continue
+        key = store.key_for(url)
+        if key:
+            return store, key
+    return None, None
+
+
+def shutdown() -> None:
+    for store in (local_storage, s3_storage):
+        if store is not None:
+            store.shutdown()
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from inference_pool import search_pool
+from ml_models import generate_text_embeddings
+
+"""Dynamic micro-batching of concurrent text queries into single CLIP calls"""
+
+logger = logging.getLogger(__name__)
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+class TextEmbeddingBatcher:
+    """Collects queries for up to max_wait_ms or max_batch_size, then encodes them together"""
+
+    def __init__(self, max_batch_size: int = 32, max_wait_ms: int = 5):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_ms = max(0, max_wait_ms)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._dispatching = set()
+        self.batches = 0
+        self.queries = 0
+        self.largest_batch = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_seen_ms = 0.0
+
+    def _ensure_started(self) -> asyncio.Queue:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._collect())
+        return self._queue
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def embed(self, text: str) -> Optional[np.ndarray]:
+        """Embed one query; resolves once the batch it joined has been encoded"""
+        queue = self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((text, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self) -> None:
+        max_wait = self.max_wait_ms / 1000.0
+        while True:
+            first = await self._queue.get()
+            batch = [first]
+            deadline = first[2] + max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Anything that arrived while we were waiting on the deadline rides along
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            # Encode in the background so the next batch can start filling
+            task = asyncio.create_task(self._dispatch(batch))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, batch: List[Tuple[str, asyncio.Future, float]]) -> None:
+        dispatched_at = time.perf_counter()
+        waits_ms = [(dispatched_at - enqueued_at) * 1000.0 for _, _, enqueued_at in batch]
+        self.batches += 1
+        self.queries += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        self.total_wait_ms += sum(waits_ms)
+        self.max_wait_seen_ms = max(self.max_wait_seen_ms, max(waits_ms))
+
+        # Identical queries in one burst are encoded once
+        unique_texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            embeddings = await search_pool.run(generate_text_embeddings, unique_texts)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        by_text = {}
+        if embeddings is not None:
+            by_text = {text: embeddings[i] for i, text in enumerate(unique_texts)}
+        for text, future, _ in batch:
+            if not future.done():
+                future.set_result(by_text.get(text))
+
+    def stats(self) -> dict:
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "batches": self.batches,
+            "queries": self.queries,
+            "avg_batch_size": round(self.queries / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "avg_wait_ms": round(self.total_wait_ms / self.queries, 3) if self.queries else 0.0,
+            "max_wait_ms_seen": round(self.max_wait_seen_ms, 3),
+        }
+
+
+text_batcher = TextEmbeddingBatcher(
+    max_batch_size=_env_int("TEXT_BATCH_MAX_SIZE", 32),
+    max_wait_ms=_env_int("TEXT_BATCH_MAX_WAIT_MS", 5),
+)
@@ -87,7 +87,7 @@ const AdminPage = () => {
       })
 
       if (response.data?.success) {
-        setUploadMessage('Upload complete.')
+        setUploadMessage('Upload queued for processing.')
         setSelectedFile(null)
         if (fileInputRef.current) {
           fileInputRef.current.value = ''
@@ -44,7 +44,9 @@ const GalleryPage = () => {
               <article key={image.id} className="gallery-card">
                 <div className="gallery-image-wrapper">
                   <img
-                    src={image.s3_url}
+                    src={image.preview_url || image.s3_url}
+                    srcSet={image.thumb_url && image.preview_url ? `${image.thumb_url} 256w, ${image.preview_url} 1024w` : undefined}
+                    sizes="(min-width: 1024px) 33vw, 50vw"
                     alt={image.caption || image.filename}
                     loading="lazy"
                     className="gallery-image"
@@ -88,7 +88,9 @@ const SearchPage = () => {
               <article key={item.id} className="result-card">
                 <div className="result-image-wrapper">
                   <img
-                    src={item.s3_url}
+                    src={item.preview_url || item.s3_url}
+                    srcSet={item.thumb_url && item.preview_url ? `${item.thumb_url} 256w, ${item.preview_url} 1024w` : undefined}
+                    sizes="(min-width: 1024px) 33vw, 50vw"
                     alt={item.caption || item.filename}
                     loading="lazy"
                     className="result-image"